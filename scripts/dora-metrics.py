@@ -24,10 +24,10 @@ import logging
 import os
 import re
 from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional, Set
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Set
 import pyodbc
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from elasticsearch.helpers import streaming_bulk
 import json
 
 # Configure logging
@@ -359,8 +359,18 @@ class DORAMetricsPipeline:
             logger.warning(f"Error parsing duration '{duration_str}': {str(e)}")
             return None
 
-    def fetch_release_frequency_data(self) -> List[Dict[str, Any]]:
-        """Fetch data from ReleaseFrequencyNew table"""
+    def fetch_rows(self, cursor) -> Iterator[Dict[str, Any]]:
+        """Yield result rows as dicts, reading --fetch-batch-size rows at a time"""
+        columns = [column[0] for column in cursor.description]
+        while True:
+            rows = cursor.fetchmany(self.args.fetch_batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(zip(columns, row))
+
+    def fetch_release_frequency_data(self) -> Iterator[Dict[str, Any]]:
+        """Stream documents from ReleaseFrequencyNew table"""
         try:
             # Use specific days for this table if provided, otherwise use default
             days_to_fetch = self.args.release_days if self.args.release_days else self.args.days
@@ -426,13 +436,11 @@ class DORAMetricsPipeline:
                 logger.info(f"Querying ReleaseFrequencyNew from {start_date_str} to {end_date_str} ({days_to_fetch} days)")
                 cursor.execute(query, start_date_str, end_date_str)
             
-            columns = [column[0] for column in cursor.description]
-            data = []
+            fetched_count = 0
             team_stats = {}  # Track team distribution
             product_stats = {}  # Track product distribution
             
-            for row in cursor.fetchall():
-                row_dict = dict(zip(columns, row))
+            for row_dict in self.fetch_rows(cursor):
                 
                 # Handle ReleaseDate - convert to datetime if it's a string
                 release_date = row_dict.get('ReleaseDate', '')
@@ -498,9 +506,10 @@ class DORAMetricsPipeline:
                     "products_cleaned": True  # Flag to indicate processing
                 }
                 
-                data.append(doc)
+                fetched_count += 1
+                yield doc
             
-            logger.info(f"Fetched {len(data)} records from ReleaseFrequencyNew table")
+            logger.info(f"Fetched {fetched_count} records from ReleaseFrequencyNew table")
             
             # Log team distribution
             if team_stats:
@@ -516,18 +525,16 @@ class DORAMetricsPipeline:
                     logger.info(f"  - {product}: {count} deployments")
             
             # If no data found and not fetching all data, suggest alternatives
-            if len(data) == 0 and not self.args.all_data:
+            if fetched_count == 0 and not self.args.all_data:
                 logger.warning(f"No ReleaseFrequencyNew data found in the specified date range")
                 logger.warning(f"Try using --all-data flag to fetch all available data, or --release-days with a larger number")
             
-            return data
-            
         except Exception as e:
             logger.error(f"Error fetching release frequency data: {str(e)}")
             raise
 
-    def fetch_lead_time_data(self) -> List[Dict[str, Any]]:
-        """Fetch data from LeadTimeForChangeTFS table"""
+    def fetch_lead_time_data(self) -> Iterator[Dict[str, Any]]:
+        """Stream documents from LeadTimeForChangeTFS table"""
         try:
             # Use specific days for this table if provided, otherwise use default
             days_to_fetch = self.args.leadtime_days if self.args.leadtime_days else self.args.days
@@ -595,13 +602,11 @@ class DORAMetricsPipeline:
                 logger.info(f"Querying LeadTimeForChangeTFS from {start_date_str} to {end_date_str} ({days_to_fetch} days)")
                 cursor.execute(query, start_date_str, end_date_str)
             
-            columns = [column[0] for column in cursor.description]
-            data = []
+            fetched_count = 0
             team_stats = {}  # Track team distribution
             product_stats = {}  # Track product distribution
             
-            for row in cursor.fetchall():
-                row_dict = dict(zip(columns, row))
+            for row_dict in self.fetch_rows(cursor):
                 
                 # Handle date fields - convert to datetime if they're strings
                 def parse_date_field(date_value):
@@ -678,9 +683,10 @@ class DORAMetricsPipeline:
                     "products_cleaned": True  # Flag to indicate processing
                 }
                 
-                data.append(doc)
+                fetched_count += 1
+                yield doc
             
-            logger.info(f"Fetched {len(data)} records from LeadTimeForChangeTFS table")
+            logger.info(f"Fetched {fetched_count} records from LeadTimeForChangeTFS table")
             
             # Log team distribution
             if team_stats:
@@ -696,49 +702,57 @@ class DORAMetricsPipeline:
                     logger.info(f"  - {product}: {count} changes")
             
             # If no data found and not fetching all data, suggest alternatives
-            if len(data) == 0 and not self.args.all_data:
+            if fetched_count == 0 and not self.args.all_data:
                 logger.warning(f"No LeadTimeForChangeTFS data found in the specified date range")
                 logger.warning(f"Try using --all-data flag to fetch all available data, or --leadtime-days with a larger number")
             
-            return data
-            
         except Exception as e:
             logger.error(f"Error fetching lead time data: {str(e)}")
             raise
 
-    def bulk_index_documents(self, index_name: str, documents: List[Dict[str, Any]]) -> bool:
-        """Bulk index documents to Elasticsearch"""
+    def bulk_index_documents(self, index_name: str, documents: Iterable[Dict[str, Any]]) -> bool:
+        """Stream documents to Elasticsearch as they are fetched"""
         try:
-            if not documents:
-                logger.warning(f"No documents to index for {index_name}")
-                return True
-            
-            # Prepare documents for bulk indexing
-            actions = []
-            for doc in documents:
-                action = {
+            # Prepare documents for bulk indexing lazily, so rows are indexed while SQL is still streaming
+            actions = (
+                {
                     "_index": index_name,
                     "_id": doc["_id"],
                     "_source": {k: v for k, v in doc.items() if k != "_id"}
                 }
-                actions.append(action)
+                for doc in documents
+            )
             
             # Perform bulk indexing
-            success_count, failed_items = bulk(
+            success_count = 0
+            failed_items = []
+            failed_count = 0
+            for ok, item in streaming_bulk(
                 self.es_client,
                 actions,
                 chunk_size=500,
+                raise_on_error=False,
                 request_timeout=60
-            )
+            ):
+                if ok:
+                    success_count += 1
+                else:
+                    failed_count += 1
+                    if len(failed_items) < 5:  # Keep first 5 failures for the log
+                        failed_items.append(item)
+            
+            if success_count == 0 and failed_count == 0:
+                logger.warning(f"No documents to index for {index_name}")
+                return True
             
             logger.info(f"Successfully indexed {success_count} documents to {index_name}")
             
-            if failed_items:
-                logger.warning(f"Failed to index {len(failed_items)} documents to {index_name}")
-                for item in failed_items[:5]:  # Log first 5 failures
+            if failed_count:
+                logger.warning(f"Failed to index {failed_count} documents to {index_name}")
+                for item in failed_items:
                     logger.warning(f"Failed item: {item}")
             
-            return len(failed_items) == 0
+            return failed_count == 0
             
         except Exception as e:
             logger.error(f"Error bulk indexing to {index_name}: {str(e)}")
@@ -873,8 +887,17 @@ def parse_arguments():
         action="store_true",
         help="Fetch all available data regardless of date range"
     )
+    parser.add_argument(
+        "--fetch-batch-size",
+        type=int,
+        default=1000,
+        help="Number of rows read from SQL Server per fetch while streaming to Elasticsearch (default: 1000)"
+    )
     
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.fetch_batch_size < 1:
+        parser.error("--fetch-batch-size must be at least 1")
+    return args
 
 
 def main():
@@ -1,136 +1,2452 @@
 #!/usr/bin/env python3
 import subprocess
+import sys
 import json
 import time
+import os
+import hashlib
+import sqlite3
+import queue
+import threading
+import cProfile
+import socket
+from array import array
+from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from collections import defaultdict
+from json.encoder import encode_basestring
 import argparse
 import math
+import heapq
+import fnmatch
+import re
+import unicodedata
+import numpy as np
 from elasticsearch import Elasticsearch, TransportError
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from elasticsearch.helpers import streaming_bulk
+
+# Field/record separators used by the single-pass `git log` format. Commit headers
+# start with RS and are followed by NUL-terminated `--numstat -z` entries.
+LOG_RECORD_SEP = '\x1e'
+LOG_FIELD_SEP = '\x1f'
+LOG_FORMAT = '%x1e%H%x1f%an%x1f%ae%x1f%ct%x1f%P%x1f%s'
+
+# Bump whenever a change to the analysis code alters the documents it produces,
+# so cached results from older versions are recomputed.
+ANALYZER_VERSION = 4
+
+# File type groups for commit impact weights (see CommitScorer).
+DOCUMENT_EXTENSIONS = {'doc', 'docx', 'ebook', 'log', 'md', 'msg', 'odt', 'org', 'pages', 'pdf', 'rtf', 'rst', 'tex', 'txt', 'wpd', 'wps'}
+CODE_EXTENSIONS = {'1.ada', '2.ada', 'ada', 'adb', 'ads', 'asm', 'bas', 'bash', 'bat', 'c', 'c++', 'cbl', 'cc', 'class', 'clj', 'cob', 'cpp', 'cs', 'csh', 'cxx', 'd', 'diff', 'e', 'el', 'f', 'f77', 'f90', 'fish', 'for', 'fth', 'ftn', 'go', 'groovy', 'h', 'hh', 'hpp', 'hs', 'html', 'htm', 'hxx', 'java', 'js', 'jsx', 'jsp', 'ksh', 'kt', 'lhs', 'lisp', 'lua', 'm', 'm4', 'nim', 'patch', 'php', 'pl', 'po', 'pp', 'py', 'r', 'rb', 'rs', 's', 'scala', 'sh', 'sql', 'swg', 'swift', 'v', 'vb', 'vcxproj', 'xcodeproj', 'xml', 'zsh'}
+CONFIG_EXTENSIONS = {'doc', 'docx', 'ebook', 'log', 'md', 'msg', 'odt', 'org', 'pages', 'pdf', 'rtf', 'rst', 'tex', 'txt', 'wpd', 'wps'}
+
+# Extension -> file class code, precompiled from the groups above. A listed
+# extension takes the weight of the first group it appears in, in the order
+# document, config, code; anything else is FILE_CLASS_OTHER.
+FILE_CLASS_OTHER, FILE_CLASS_DOCUMENT, FILE_CLASS_CONFIG, FILE_CLASS_CODE = range(4)
+FILE_CLASS_WEIGHTS = np.array([0.3, 0.3, 0.7, 0.6])
+EXTENSION_CLASSES = {ext: FILE_CLASS_CODE for ext in CODE_EXTENSIONS}
+EXTENSION_CLASSES.update({ext: FILE_CLASS_CONFIG for ext in CONFIG_EXTENSIONS})
+EXTENSION_CLASSES.update({ext: FILE_CLASS_DOCUMENT for ext in DOCUMENT_EXTENSIONS})
+
+# Commit categories, in the order GitCommitAnalyzer.category_weights breaks ties.
+CATEGORIES = ('Refactor', 'New Work', 'Help Others', 'Churn/Rework')
+CATEGORY_CODES = {category: code for code, category in enumerate(CATEGORIES)}
+
+
+def iter_nul_tokens(stream, chunk_size=65536):
+    """
+    Reads a binary stream incrementally and yields the NUL-separated tokens
+    as decoded strings, without buffering the whole output in memory.
+    """
+    pending = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        pending += chunk
+        *tokens, pending = pending.split(b'\0')
+        for token in tokens:
+            yield token.decode('utf-8', errors='replace')
+    if pending:
+        yield pending.decode('utf-8', errors='replace')
+
+
+def file_extension(path):
+    """
+    Lowercase extension of a path ('' when it has none), as used for impact weights.
+    """
+    return path.rsplit('.', 1)[-1].lower() if '.' in path else ''
+
+
+class FileStat:
+    """
+    Numstat entry of one changed file. Slotted, so a commit costs a fraction of
+    the memory of one dictionary per file. It also answers the read-only
+    mapping access (stat['file'], stat.get('previous_file')) used on the file
+    dictionaries of cached and indexed documents, so both share the same code.
+    """
+    __slots__ = ('insertions', 'deletions', 'file', 'previous_file')
+
+    def __init__(self, insertions, deletions, file, previous_file=None):
+        self.insertions = insertions
+        self.deletions = deletions
+        self.file = file
+        self.previous_file = previous_file
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        # A missing previous_file reads as absent, like in the document's dictionary.
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        return default if value is None else value
+
+    def as_dict(self):
+        stat = {'insertions': self.insertions, 'deletions': self.deletions, 'file': self.file}
+        if self.previous_file is not None:
+            stat['previous_file'] = self.previous_file
+        return stat
+
+    def to_json(self):
+        body = f'"insertions":{self.insertions},"deletions":{self.deletions},"file":{encode_basestring(self.file)}'
+        if self.previous_file is not None:
+            body += f',"previous_file":{encode_basestring(self.previous_file)}'
+        return '{' + body + '}'
+
+    def __repr__(self):
+        return f"FileStat({self.as_dict()})"
+
+
+def encode_record(value):
+    if isinstance(value, FileStat):
+        return value.as_dict()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps_document(doc):
+    """
+    Serialises a document in one step for the bulk request body and the commit
+    cache, with orjson when it is installed. Bulk actions carry the resulting
+    string as their _source, which the Elasticsearch client sends unchanged.
+    The commit cache also stores None (skipped commits) and the document lists
+    of --path_map runs.
+    """
+    if orjson is not None:
+        return orjson.dumps(doc, default=encode_record).decode('utf-8')
+    files = doc.get('files') if isinstance(doc, dict) else None
+    if not files:
+        return json.dumps(doc, default=encode_record, ensure_ascii=False, separators=(',', ':'))
+    # The standard encoder would call back into Python for every FileStat;
+    # the file list is joined from their own JSON instead and appended last.
+    rest = json.dumps({key: value for key, value in doc.items() if key != 'files'},
+                      default=encode_record, ensure_ascii=False, separators=(',', ':'))
+    files_json = ','.join(
+        stat.to_json() if isinstance(stat, FileStat) else json.dumps(stat, ensure_ascii=False, separators=(',', ':'))
+        for stat in files
+    )
+    return f'{rest[:-1]}{"," if len(rest) > 2 else ""}"files":[{files_json}]}}'
+
+
+class FileStatList(list):
+    """
+    File stats of a commit, with the totals of the files an ExcludedPathMatcher
+    removed: skipped is (files, insertions, deletions), or None.
+    """
+    skipped = None
+
+
+class FileStatsSummary:
+    """
+    Bounded-memory aggregate of the file stats of a mega-commit (vendor drops,
+    mass renames). Instead of one dictionary per file it keeps totals per
+    extension and per directory (the first directory_depth path components),
+    the changed lines per parent directory for the ownership index, the top_n
+    most changed files, and only the changed path strings, which the last-touch
+    index still needs.
+    """
+    skipped = None  # see FileStatList
+
+    def __init__(self, top_n=100, directory_depth=2):
+        self.top_n = top_n
+        self.directory_depth = directory_depth
+        self.file_count = 0
+        self.insertions = 0
+        self.deletions = 0
+        self.extensions = {}  # extension -> [files, insertions, deletions]
+        self.directories = {}  # directory -> [files, insertions, deletions]
+        self.parent_lines = {}  # full parent directory -> changed lines
+        self.top = []  # min-heap of (changes, sequence, stat)
+        self.paths = []  # (file, previous_file or None)
+
+    def add(self, stat):
+        insertions = stat['insertions']
+        deletions = stat['deletions']
+        self.file_count += 1
+        self.insertions += insertions
+        self.deletions += deletions
+        for totals, key in ((self.extensions, file_extension(stat['file'])),
+                            (self.directories, self.directory_of(stat['file']))):
+            entry = totals.setdefault(key, [0, 0, 0])
+            entry[0] += 1
+            entry[1] += insertions
+            entry[2] += deletions
+        parent = stat['file'].rpartition('/')[0]
+        self.parent_lines[parent] = self.parent_lines.get(parent, 0) + insertions + deletions
+
+        item = (insertions + deletions, self.file_count, stat)
+        if len(self.top) < self.top_n:
+            heapq.heappush(self.top, item)
+        elif item[0] > self.top[0][0]:
+            heapq.heapreplace(self.top, item)
+        self.paths.append((stat['file'], stat.get('previous_file')))
+
+    def directory_of(self, path):
+        parts = path.split('/')[:-1]
+        return '/'.join(parts[:self.directory_depth])
+
+    def top_files(self):
+        return [stat for _, _, stat in sorted(self.top, key=lambda item: (-item[0], item[1]))]
+
+    def directory_lines(self):
+        return {directory: lines for directory, lines in sorted(self.parent_lines.items()) if lines}
+
+    def extension_totals(self):
+        return [
+            {'extension': extension, 'files': files, 'insertions': insertions, 'deletions': deletions}
+            for extension, (files, insertions, deletions) in sorted(self.extensions.items())
+        ]
+
+
+def iter_changed_paths(file_stats):
+    """
+    Yields (file, previous_file) for a list of file stats, a FileStatsSummary or
+    the per-project stats of a --path_map run.
+    """
+    if isinstance(file_stats, dict):
+        for stats in file_stats.values():
+            yield from iter_changed_paths(stats)
+    elif isinstance(file_stats, FileStatsSummary):
+        yield from file_stats.paths
+    else:
+        for stat in file_stats:
+            yield stat['file'], stat.get('previous_file')
+
+
+class NumstatParser:
+    """
+    Incremental parser for `--numstat -z` entries, fed one NUL-separated token
+    at a time. A plain entry is "ins\tdel\tpath"; a rename is "ins\tdel\t"
+    followed by the old and the new path as two separate tokens. Binary files
+    ("-\t-", also files marked -diff) are skipped; excluded ones still count
+    as skipped files.
+
+    Once more than summarize_above files have been seen, the stats collected so
+    far are folded into a FileStatsSummary and later entries go straight into it.
+    Files the exclude matcher (an ExcludedPathMatcher) rejects are only counted
+    and do not count towards that threshold.
+    """
+
+    def __init__(self, summarize_above=None, top_n=100, exclude=None):
+        self.summarize_above = summarize_above
+        self.top_n = top_n
+        self.exclude = exclude
+        self.stats = FileStatList()
+        self.summary = None
+        self.pending = None
+        self.skipped = [0, 0, 0]
+
+    def feed(self, token):
+        if self.pending is not None:
+            self.pending.append(token)
+            if len(self.pending) < 4:
+                return
+            parts, self.pending = self.pending, None
+        else:
+            if not token.strip():
+                return
+            parts = token.split('\t', 2)
+            if len(parts) < 3:
+                return
+            if parts[2] == '':
+                # Rename or copy: the paths arrive in the next two tokens.
+                self.pending = parts[:2]
+                return
+        if not (parts[0].isdigit() and parts[1].isdigit()):
+            # Binary, or -diff through .gitattributes: there are no line counts,
+            # so an excluded one is only counted as a skipped file.
+            if self.exclude is not None and self.exclude.excluded(parts[-1]):
+                self.skipped[0] += 1
+            return
+        self.add(FileStat(int(parts[0]), int(parts[1]), parts[-1], parts[2] if len(parts) == 4 else None))
+
+    def add(self, stat):
+        if self.exclude is not None and self.exclude.excluded(stat['file']):
+            self.skipped[0] += 1
+            self.skipped[1] += stat['insertions']
+            self.skipped[2] += stat['deletions']
+            return
+        if self.summary is not None:
+            self.summary.add(stat)
+            return
+        self.stats.append(stat)
+        if self.summarize_above and len(self.stats) > self.summarize_above:
+            self.summary = FileStatsSummary(self.top_n)
+            for collected in self.stats:
+                self.summary.add(collected)
+            self.stats = None
+
+    def result(self):
+        """
+        Returns the FileStatList of file stats, or the FileStatsSummary for a mega-commit.
+        """
+        result = self.summary if self.summary is not None else self.stats
+        if self.skipped[0]:
+            result.skipped = tuple(self.skipped)
+        return result
+
+
+class ProjectPathMap:
+    """
+    --path_map: assigns the changed paths of a monorepo to project/repository
+    pairs, so a single history walk yields one document per (commit, project).
+    Each line is "pattern,project_name,repository_name" and the first matching
+    line wins. A pattern without glob characters matches that path and
+    everything below it; otherwise fnmatch rules apply ('*' also matches '/').
+    Paths no line matches belong to the default pair. Lookups are memoised per path.
+    """
+
+    def __init__(self, rules, default):
+        self.rules = rules
+        self.default = default
+        self.matches = {}
+
+    @classmethod
+    def load(cls, path_map_file, default):
+        """
+        Loads a path map file, e.g.:
+            services/billing,Payments,billing-service
+            services/*/docs/*,Docs,service-docs
+        Empty lines and lines starting with '#' are ignored.
+        """
+        rules = []
+        with open(path_map_file, 'r', encoding='utf-8') as f:
+            for line_num, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                parts = [part.strip() for part in line.split(',')]
+                if len(parts) != 3 or not all(parts):
+                    print(f"Warning: {path_map_file}:{line_num}: expected 'pattern,project_name,repository_name', got '{line}'")
+                    continue
+                rules.append(tuple(parts))
+        return cls(rules, default)
+
+    def keys(self):
+        """
+        Every (project_name, repository_name) pair the map can produce, default first.
+        """
+        keys = [self.default]
+        for _, project_name, repository_name in self.rules:
+            if (project_name, repository_name) not in keys:
+                keys.append((project_name, repository_name))
+        return keys
+
+    def key_for(self, path):
+        key = self.matches.get(path)
+        if key is None:
+            key = self.default
+            for pattern, project_name, repository_name in self.rules:
+                if self.match(pattern, path):
+                    key = (project_name, repository_name)
+                    break
+            self.matches[path] = key
+        return key
+
+    @staticmethod
+    def match(pattern, path):
+        if any(c in pattern for c in '*?['):
+            return fnmatch.fnmatchcase(path, pattern)
+        prefix = pattern.rstrip('/')
+        return path == prefix or path.startswith(prefix + '/')
+
+
+class PartitionedNumstatParser(NumstatParser):
+    """
+    NumstatParser for --path_map runs: every entry goes to the parser of the
+    project owning its path, so the mega-commit threshold applies per project.
+    result() returns {(project_name, repository_name): file stats}.
+    """
+
+    def __init__(self, path_map, summarize_above=None, top_n=100, exclude=None):
+        super().__init__(summarize_above, top_n, exclude)
+        self.path_map = path_map
+        self.parts = {}
+
+    def add(self, stat):
+        key = self.path_map.key_for(stat['file'])
+        if key not in self.parts:
+            self.parts[key] = NumstatParser(self.summarize_above, self.top_n, self.exclude)
+        self.parts[key].add(stat)
+
+    def result(self):
+        return {key: parser.result() for key, parser in self.parts.items()}
+
+
+def compile_path_pattern(pattern, base='', match_below=False):
+    """
+    Compiles a .gitattributes style pattern, relative to the directory base
+    ('' or 'dir/'), into a regex. A pattern without a '/' matches the file name
+    at any depth, otherwise it is anchored to base; '*' and '?' stop at '/',
+    '**' crosses directories. With match_below the files inside a matched
+    directory match as well (gitignore behaviour, used for --exclude).
+    """
+    anchored = '/' in pattern.rstrip('/')
+    pattern = pattern.strip('/')
+    regex = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            regex.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            regex.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            body = pattern[i + 1:end]
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            regex.append('[' + body.replace('\\', '\\\\') + ']')
+            i = end + 1
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    prefix = re.escape(base) if anchored else re.escape(base) + '(?:.*/)?'
+    suffix = '(?:/.*)?' if match_below else ''
+    return re.compile(prefix + ''.join(regex) + suffix + r'\Z')
+
+
+class ExcludedPathMatcher:
+    """
+    Decides which changed files are left out of categorization and scoring:
+    files the repository's .gitattributes mark as linguist-generated,
+    linguist-vendored or -diff (also through the binary macro), and files
+    matching an --exclude pattern. Every path is classified once.
+    """
+    ATTRIBUTES = ('linguist-generated', 'linguist-vendored', 'diff')
+
+    def __init__(self, attribute_rules, exclude_patterns):
+        # [(regex, {attribute: True/False/None})], lowest precedence first.
+        self.attribute_rules = attribute_rules
+        self.exclude_patterns = list(exclude_patterns)
+        self.excludes = [compile_path_pattern(pattern, match_below=True) for pattern in self.exclude_patterns]
+        self.sources = []
+        self.cache = {}
+
+    @classmethod
+    def from_repository(cls, run_git_command, exclude_patterns):
+        """
+        Reads every .gitattributes file at HEAD. Attributes of later history are
+        applied to all commits, as git itself does for a checkout.
+        """
+        matcher = cls([], exclude_patterns)
+        listing = run_git_command(['git', 'ls-tree', '-r', '--name-only', 'HEAD']) or ''
+        paths = [path for path in listing.splitlines()
+                 if path == '.gitattributes' or path.endswith('/.gitattributes')]
+        # Deeper files override shallower ones.
+        for path in sorted(paths, key=lambda p: p.count('/')):
+            content = run_git_command(['git', 'show', f'HEAD:{path}'])
+            if content:
+                matcher.add_gitattributes(content, path[:-len('.gitattributes')])
+                matcher.sources.append((path, content))
+        return matcher
+
+    def add_gitattributes(self, content, base):
+        for line in content.splitlines():
+            fields = line.split()
+            if not fields or fields[0].startswith('#') or fields[0].startswith('[attr]'):
+                continue
+            attributes = {}
+            for field in fields[1:]:
+                if field == 'binary':
+                    attributes['diff'] = False
+                    continue
+                name, _, value = field.partition('=')
+                state = True
+                if name and name[0] in '-!':
+                    name, state = name[1:], False if name[0] == '-' else None
+                elif value:
+                    state = value.lower() not in ('false', '0')
+                if name in self.ATTRIBUTES:
+                    attributes[name] = state
+            if attributes:
+                self.attribute_rules.append((compile_path_pattern(fields[0], base), attributes))
+
+    def excluded(self, path):
+        result = self.cache.get(path)
+        if result is None:
+            result = any(regex.match(path) for regex in self.excludes)
+            if not result and self.attribute_rules:
+                attributes = {}
+                for regex, values in self.attribute_rules:
+                    if regex.match(path):
+                        attributes.update(values)
+                result = bool(attributes.get('linguist-generated') or attributes.get('linguist-vendored')
+                              or attributes.get('diff') is False)
+            self.cache[path] = result
+        return result
+
+
+def round_values(values, digits):
+    """
+    Rounds an array like the built-in round(). np.round scales in binary and now
+    and then lands on the other side of a tie, which would make scores differ from
+    documents indexed by the scalar code.
+    """
+    return np.array([round(value, digits) for value in values.tolist()])
+
+
+class ScoreBlock:
+    """
+    Columnar block of commits for CommitScorer. Each commit is one row of
+    insertions, deletions, files changed and category counts; its files are rows
+    of a second table (changed lines, file class, commit row). A summarised
+    commit contributes one file row per extension total.
+    """
+
+    def __init__(self):
+        self.counts = []
+        self.categories = []
+        self.insertions = []
+        self.deletions = []
+        self.files_changed = []
+        self.file_rows = []
+        self.file_lines = []
+        self.file_classes = []
+
+    def __len__(self):
+        return len(self.insertions)
+
+    def add(self, insertions, deletions, file_stats, category_counts=None, category=None):
+        """
+        Adds a commit. The category is derived from category_counts when given,
+        otherwise category is kept as it is.
+        """
+        row = len(self.insertions)
+        self.counts.append([category_counts.get(c, 0) for c in CATEGORIES] if category_counts else None)
+        self.categories.append(CATEGORY_CODES.get(category, len(CATEGORIES)))
+        self.insertions.append(insertions)
+        self.deletions.append(deletions)
+        if isinstance(file_stats, FileStatsSummary):
+            for ext, (_, ext_insertions, ext_deletions) in file_stats.extensions.items():
+                self.add_file(row, ext, ext_insertions + ext_deletions)
+            self.files_changed.append(file_stats.file_count)
+        else:
+            for stat in file_stats:
+                self.add_file(row, file_extension(stat['file']), stat['insertions'] + stat['deletions'])
+            self.files_changed.append(len(file_stats))
+
+    def add_document(self, doc):
+        if doc.get('files_summarized'):
+            row = len(self.insertions)
+            self.add(doc['insertions'], doc['deletions'], [], doc.get('category_counts'), doc['category'])
+            for totals in doc['file_extensions']:
+                self.add_file(row, totals['extension'], totals['insertions'] + totals['deletions'])
+            self.files_changed[row] = doc['total_files_changed']
+        else:
+            self.add(doc['insertions'], doc['deletions'], doc['files'], doc.get('category_counts'), doc['category'])
+
+    def add_file(self, row, ext, lines):
+        self.file_rows.append(row)
+        self.file_lines.append(lines)
+        self.file_classes.append(EXTENSION_CLASSES.get(ext, FILE_CLASS_OTHER))
+
+
+class CommitScorer:
+    """
+    Computes commit category, cefficiency and commit_impact for a whole ScoreBlock
+    with NumPy array operations. Per-commit scoring goes through the same code
+    with a one-row block, so backfills and --rescore produce identical scores.
+    """
+
+    def __init__(self, category_weights, efficiency_weights, impact_steepness, impact_midpoint):
+        self.category_weights = np.array([category_weights[c] for c in CATEGORIES], dtype=float)
+        # One extra slot for categories outside CATEGORIES.
+        self.efficiency_weights = np.array([efficiency_weights.get(c, 0.5) for c in CATEGORIES] + [0.5])
+        self.impact_steepness = impact_steepness
+        self.impact_midpoint = impact_midpoint
+
+    def categorize(self, block):
+        """
+        Category code per commit: the category with the highest weighted count
+        (first one on ties), or the stored category when counts are missing.
+        """
+        categories = np.array(block.categories, dtype=np.intp)
+        rows = [row for row, counts in enumerate(block.counts) if counts]
+        if rows:
+            counts = np.array([block.counts[row] for row in rows], dtype=float)
+            categories[rows] = np.argmax(counts * self.category_weights, axis=1)
+        return categories
+
+    def efficiency(self, categories, insertions, deletions):
+        total = insertions + deletions
+        ratio = np.divide(insertions, total, out=np.zeros_like(total), where=total > 0)
+        return round_values(ratio * self.efficiency_weights[categories] * 100, 2)
+
+    def raw_impact(self, block):
+        """
+        Sum of changed lines times file type weight per commit, plus the same
+        amount again for every changed file.
+        """
+        weighted = np.bincount(
+            np.array(block.file_rows, dtype=np.intp),
+            weights=np.array(block.file_lines, dtype=float) * FILE_CLASS_WEIGHTS[np.array(block.file_classes, dtype=np.intp)],
+            minlength=len(block)
+        )
+        return weighted + np.array(block.files_changed, dtype=float) * weighted
+
+    def impact(self, raw_impact):
+        """
+        Maps raw impact to [1.0, 100.0] with the logistic function
+            1 + 99 / (1 + exp(-k * (raw_impact - x0)))
+        where k (impact_steepness) controls the steepness of the curve and x0
+        (impact_midpoint) is the midpoint of the raw impact scale.
+        """
+        lower_bound = 1.0
+        upper_bound = 100.0
+        with np.errstate(over='ignore'):
+            normalized = lower_bound + (upper_bound - lower_bound) / (
+                1 + np.exp(-self.impact_steepness * (raw_impact - self.impact_midpoint)))
+        return round_values(normalized, 1)
+
+    def score(self, block):
+        """
+        Returns (category codes, cefficiency, commit_impact, raw impact) arrays for a block.
+        """
+        categories = self.categorize(block)
+        insertions = np.array(block.insertions, dtype=float)
+        deletions = np.array(block.deletions, dtype=float)
+        raw_impact = self.raw_impact(block)
+        return categories, self.efficiency(categories, insertions, deletions), self.impact(raw_impact), raw_impact
+
+
+class P2Quantile:
+    """
+    Streaming estimate of one quantile with the P-squared algorithm (Jain and
+    Chlamtac): five markers whose heights are adjusted with a piecewise-parabolic
+    formula as observations arrive, so memory stays constant however many
+    values are added. The state is plain lists and can be stored as JSON.
+    """
+
+    def __init__(self, q, state=None):
+        self.q = q
+        state = state or {}
+        self.count = state.get('count', 0)
+        self.heights = state.get('heights', [])
+        self.positions = state.get('positions', [1, 2, 3, 4, 5])
+        self.desired = state.get('desired', [1, 1 + 2 * q, 1 + 4 * q, 3 + 2 * q, 5])
+
+    def state(self):
+        return {
+            'count': self.count,
+            'heights': self.heights,
+            'positions': self.positions,
+            'desired': self.desired
+        }
+
+    def add(self, value):
+        self.count += 1
+        heights = self.heights
+        if self.count <= 5:
+            heights.append(value)
+            heights.sort()
+            return
+
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = next(i for i in range(4) if heights[i] <= value < heights[i + 1])
+
+        for i in range(cell + 1, 5):
+            self.positions[i] += 1
+        increments = (0, self.q / 2, self.q, (1 + self.q) / 2, 1)
+        for i in range(5):
+            self.desired[i] += increments[i]
+
+        for i in (1, 2, 3):
+            offset = self.desired[i] - self.positions[i]
+            if ((offset >= 1 and self.positions[i + 1] - self.positions[i] > 1) or
+                    (offset <= -1 and self.positions[i - 1] - self.positions[i] < -1)):
+                step = 1 if offset > 0 else -1
+                height = self.parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self.linear(i, step)
+                heights[i] = height
+                self.positions[i] += step
+
+    def parabolic(self, i, step):
+        h, n = self.heights, self.positions
+        return h[i] + step / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (h[i + 1] - h[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - step) * (h[i] - h[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def linear(self, i, step):
+        h, n = self.heights, self.positions
+        return h[i] + step * (h[i + step] - h[i]) / (n[i + step] - n[i])
+
+    def value(self):
+        if not self.heights:
+            return None
+        if self.count <= 5:
+            # Exact quantile of the few values seen so far.
+            return self.heights[min(len(self.heights) - 1, int(round(self.q * (len(self.heights) - 1))))]
+        return self.heights[2]
+
+
+class ImpactSketch:
+    """
+    Constant-memory summary of the raw commit impact of one repository: P-squared
+    estimates of its 10th, 50th and 90th percentiles. calibration() turns them
+    into the logistic midpoint and steepness of CommitScorer.impact.
+    """
+
+    QUANTILES = (0.1, 0.5, 0.9)
+    # Fewer commits than this give percentiles too noisy to calibrate with.
+    MIN_COMMITS = 50
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.estimators = [P2Quantile(q, state.get(str(q))) for q in self.QUANTILES]
+
+    @property
+    def count(self):
+        return self.estimators[0].count
+
+    def add(self, raw_impact):
+        for estimator in self.estimators:
+            estimator.add(raw_impact)
+
+    def state(self):
+        return {str(estimator.q): estimator.state() for estimator in self.estimators}
+
+    def calibration(self):
+        """
+        Returns {'midpoint', 'steepness', 'commits'}, or None when too few commits
+        were seen. The median becomes the midpoint (impact 50.5); the steepness
+        maps the 10th and 90th percentiles to about 10 and 90 for a symmetric
+        distribution.
+        """
+        if self.count < self.MIN_COMMITS:
+            return None
+        low, median, high = (estimator.value() for estimator in self.estimators)
+        if high <= low:
+            return None
+        return {
+            'midpoint': round(median, 4),
+            'steepness': round(2 * math.log(9) / (high - low), 8),
+            'commits': self.count
+        }
+
+
+class SketchedCommits:
+    """
+    SHAs whose raw impact is already in the impact sketch of their project/
+    repository, kept in --state_dir. Cache hits, re-runs and the overlapping
+    --since windows of nightly runs emit the same commits again; only commits
+    not seen before are added, so every commit weighs the same in the sketch.
+    New SHAs are written by save() in one transaction once the sketches were
+    stored, so analyzers of a --manifest run do not hold the file's lock.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS sketched_commits ('
+            'project_name TEXT, repository_name TEXT, sha TEXT, '
+            'PRIMARY KEY (project_name, repository_name, sha))'
+        )
+        self.conn.commit()
+        self.pending = set()
+
+    def add(self, project_name, repository_name, sha):
+        """
+        Records a commit; returns False when it was already counted.
+        """
+        key = (project_name, repository_name, sha)
+        if key in self.pending:
+            return False
+        if self.conn.execute(
+            'SELECT 1 FROM sketched_commits WHERE project_name = ? AND repository_name = ? AND sha = ?', key
+        ).fetchone():
+            return False
+        self.pending.add(key)
+        return True
+
+    def save(self):
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO sketched_commits VALUES (?, ?, ?)', sorted(self.pending))
+        self.pending.clear()
+
+    def close(self):
+        self.conn.close()
+
+
+def load_state_file(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def update_state_file(path, key, value):
+    """
+    Sets one key of a JSON file in --state_dir. Other keys may belong to other
+    analyzers of a --manifest run, so the file is re-read under a lock and
+    replaced atomically so an interrupted run never leaves it half written.
+    """
+    with _state_lock:
+        entries = load_state_file(path)
+        entries[key] = value
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+
+class RefContainment:
+    """
+    Records which of the selected refs contain each walked commit, from a single
+    `git rev-list --topo-order --parents` walk over all ref tips. Children come
+    before their parents in that order, so every commit hands its set of refs
+    (a bit mask) down to its parents and shared history is walked once instead
+    of once per branch.
+    """
+
+    def __init__(self, names, masks):
+        self.names = names
+        self.masks = masks
+        self.lists = {}  # mask -> sorted ref names, shared by commits with the same refs
+
+    @classmethod
+    def build(cls, repo_path, tips, rev_args, profiler):
+        """
+        tips maps ref names to the commits they point to; rev_args is the walk
+        the analysis itself uses.
+        """
+        names = sorted(tips)
+        pending = {}
+        for bit, name in enumerate(names):
+            pending[tips[name]] = pending.get(tips[name], 0) | (1 << bit)
+
+        masks = {}
+        cmd = ['git', 'rev-list', '--topo-order', '--parents'] + rev_args
+        started = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, cwd=repo_path)
+        try:
+            for line in proc.stdout:
+                commit_hash, *parents = line.split()
+                mask = pending.pop(commit_hash, 0)
+                masks[commit_hash] = mask
+                for parent in parents:
+                    pending[parent] = pending.get(parent, 0) | mask
+        finally:
+            proc.stdout.close()
+            if proc.wait() != 0:
+                print(f"Git command failed: {' '.join(cmd)} exited with {proc.returncode}")
+            profiler.git_call('rev-list', time.perf_counter() - started)
+        return cls(names, masks)
+
+    def refs_for(self, commit_hash):
+        mask = self.masks.get(commit_hash, 0)
+        if mask not in self.lists:
+            self.lists[mask] = [name for bit, name in enumerate(self.names) if mask >> bit & 1]
+        return self.lists[mask]
+
+
+# Turkish dotted and dotless i, which str.casefold() keeps apart ('I' -> 'i',
+# 'İ' -> 'i̇', 'ı' unchanged), all fold to a plain 'i'.
+TURKISH_I_FOLD = str.maketrans({'İ': 'i', 'I': 'i', 'ı': 'i'})
+
+
+def fold_identity(value):
+    """
+    Case-insensitive lookup key for a person's name or alias, with collapsed
+    whitespace and the Turkish i variants folded together.
+    """
+    value = unicodedata.normalize('NFC', ' '.join(value.split()))
+    return value.translate(TURKISH_I_FOLD).casefold()
+
+
+class IdentityResolver:
+    """
+    Resolves a commit author (name, email) to (alias, team) with the user
+    mapping (name -> alias) and the teams mapping (developer name -> team).
+    Each distinct identity is resolved once.
+
+    The alias comes from an exact name match, then a folded one, then an author
+    name or email local part that already is an alias; without a match the name
+    is kept.
+    The team is looked up for the author name, the alias and the names mapped
+    to that alias, in that order.
+    """
+
+    def __init__(self, users, teams, default_team='Non'):
+        self.users = users
+        self.folded_users = {fold_identity(name): alias for name, alias in users.items()}
+        self.aliases = {fold_identity(alias): alias for alias in users.values()}
+        self.names_by_alias = defaultdict(list)
+        for name, alias in users.items():
+            self.names_by_alias[alias].append(name)
+        self.teams = {fold_identity(developer): team for developer, team in (teams or {}).items()}
+        self.default_team = default_team
+        self.resolved = {}
+
+    def resolve(self, name, email=''):
+        identity = (name, email)
+        result = self.resolved.get(identity)
+        if result is None:
+            result = self.resolved[identity] = self._resolve(name, email)
+        return result
+
+    def _resolve(self, name, email):
+        stripped = name.strip() if name else ""
+        alias = self.users.get(stripped)
+        if alias is None:
+            alias = self.folded_users.get(fold_identity(stripped))
+        if alias is None:
+            alias = self.aliases.get(fold_identity(stripped))
+        if alias is None and email:
+            alias = self.aliases.get(fold_identity(email.split('@', 1)[0]))
+
+        team = self.default_team
+        for candidate in [stripped, alias] + self.names_by_alias.get(alias, []):
+            if candidate and fold_identity(candidate) in self.teams:
+                team = self.teams[fold_identity(candidate)]
+                break
+        return (alias if alias is not None else name), team
+
+
+class CommitCache:
+    """
+    SQLite-backed store of the documents process_commit produced, keyed by
+    project/repository and commit SHA. Each entry carries the fingerprint of the
+    analyzer settings it was computed with; entries with a different fingerprint
+    are treated as misses and overwritten.
+    """
+
+    def __init__(self, path, fingerprint, commit_every=500):
+        # Several analyzers of a --manifest run may share the file; wait for locks.
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS commit_docs ('
+            'project_name TEXT, repository_name TEXT, sha TEXT, fingerprint TEXT, doc TEXT, '
+            'PRIMARY KEY (project_name, repository_name, sha))'
+        )
+        self.conn.commit()
+        self.fingerprint = fingerprint
+        self.commit_every = commit_every
+        # (project, repository, sha) -> serialised document, written by flush() in
+        # one short transaction so analyzers sharing the file never wait for a
+        # transaction another analyzer keeps open while it works.
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, project_name, repository_name, sha):
+        """
+        Returns (True, doc) on a hit, where doc may be None for commits that were
+        skipped (merges, no file changes), and (False, None) on a miss.
+        """
+        key = (project_name, repository_name, sha)
+        if key in self.pending:
+            self.hits += 1
+            return True, json.loads(self.pending[key])
+        row = self.conn.execute(
+            'SELECT fingerprint, doc FROM commit_docs WHERE project_name = ? AND repository_name = ? AND sha = ?',
+            key
+        ).fetchone()
+        if row is None or row[0] != self.fingerprint:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, json.loads(row[1])
+
+    def put(self, project_name, repository_name, sha, doc):
+        self.pending[(project_name, repository_name, sha)] = dumps_document(doc)
+        if len(self.pending) >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO commit_docs VALUES (?, ?, ?, ?, ?)',
+                [key + (self.fingerprint, doc) for key, doc in self.pending.items()]
+            )
+        self.pending.clear()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+# Backoff before a chunk whose documents failed to index is leased again:
+# doubles with every attempt, up to the maximum.
+QUEUE_RETRY_BASE_SECONDS = 30
+QUEUE_RETRY_MAX_SECONDS = 900
+
+
+class WorkQueue:
+    """
+    Durable SQLite queue of backfill chunks for --queue runs. The coordinator
+    stores a repository's commits as numbered chunks; workers on one or more
+    hosts lease a chunk for a limited time, renew the lease while they work on
+    it and mark it done. A chunk whose lease ran out (crashed or stopped worker)
+    can be leased again, and finished chunks are never handed out twice, so an
+    interrupted backfill resumes where it stopped. A chunk that could not be
+    indexed waits with an exponential backoff before it is leased again and is
+    marked failed after max_attempts leases.
+
+    Workers on several machines need the file on a filesystem with working
+    locks (e.g. a local disk shared over NFSv4 with locking, not SMB).
+    """
+
+    def __init__(self, path):
+        # Autocommit; the lease transaction is opened explicitly.
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS chunks ('
+            'project_name TEXT, repository_name TEXT, chunk INTEGER, commits TEXT, '
+            "status TEXT DEFAULT 'pending', worker TEXT, lease_until REAL, attempts INTEGER DEFAULT 0, "
+            'PRIMARY KEY (project_name, repository_name, chunk))'
+        )
+
+    def add_chunks(self, project_name, repository_name, chunks):
+        """
+        Stores the chunks of a repository unless it already has some, in which
+        case the existing plan is resumed. Returns True when chunks were added.
+        """
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            exists = self.conn.execute(
+                'SELECT 1 FROM chunks WHERE project_name = ? AND repository_name = ? LIMIT 1',
+                (project_name, repository_name)
+            ).fetchone()
+            if not exists:
+                self.conn.executemany(
+                    'INSERT INTO chunks (project_name, repository_name, chunk, commits) VALUES (?, ?, ?, ?)',
+                    [(project_name, repository_name, number, json.dumps(commits))
+                     for number, commits in enumerate(chunks)]
+                )
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        return not exists
+
+    def lease(self, project_name, repository_name, worker, seconds):
+        """
+        Leases the lowest pending (or expired) chunk whose backoff has passed.
+        Returns (chunk, commits, attempts), or None when there is nothing to
+        lease right now.
+        """
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.conn.execute(
+                'SELECT chunk, commits, attempts FROM chunks WHERE project_name = ? AND repository_name = ? '
+                "AND status IN ('pending', 'leased') AND (lease_until IS NULL OR lease_until < ?) "
+                'ORDER BY chunk LIMIT 1',
+                (project_name, repository_name, now)
+            ).fetchone()
+            if row:
+                self.conn.execute(
+                    "UPDATE chunks SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                    'WHERE project_name = ? AND repository_name = ? AND chunk = ?',
+                    (worker, now + seconds, project_name, repository_name, row[0])
+                )
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        return (row[0], json.loads(row[1]), row[2] + 1) if row else None
+
+    def _update_leased(self, sql, params, project_name, repository_name, chunk, worker):
+        cursor = self.conn.execute(
+            sql + " WHERE project_name = ? AND repository_name = ? AND chunk = ? AND worker = ? AND status = 'leased'",
+            params + (project_name, repository_name, chunk, worker)
+        )
+        return cursor.rowcount == 1
+
+    def renew(self, project_name, repository_name, chunk, worker, seconds):
+        """
+        Extends a lease. False means it expired and was taken by another worker.
+        """
+        return self._update_leased('UPDATE chunks SET lease_until = ?', (time.time() + seconds,),
+                                   project_name, repository_name, chunk, worker)
+
+    def complete(self, project_name, repository_name, chunk, worker):
+        return self._update_leased("UPDATE chunks SET status = 'done', lease_until = NULL", (),
+                                   project_name, repository_name, chunk, worker)
+
+    def release(self, project_name, repository_name, chunk, worker, retry_after=0.0):
+        """
+        Returns a chunk to the queue; it can be leased again after retry_after seconds.
+        """
+        return self._update_leased("UPDATE chunks SET status = 'pending', lease_until = ?",
+                                   (time.time() + retry_after if retry_after > 0 else None,),
+                                   project_name, repository_name, chunk, worker)
+
+    def fail(self, project_name, repository_name, chunk, worker):
+        return self._update_leased("UPDATE chunks SET status = 'failed', lease_until = NULL", (),
+                                   project_name, repository_name, chunk, worker)
+
+    def retry_failed(self, project_name, repository_name):
+        """
+        Puts failed chunks back into the queue with a fresh attempt count.
+        Returns the number of chunks reset.
+        """
+        return self.conn.execute(
+            "UPDATE chunks SET status = 'pending', worker = NULL, lease_until = NULL, attempts = 0 "
+            "WHERE project_name = ? AND repository_name = ? AND status = 'failed'",
+            (project_name, repository_name)
+        ).rowcount
+
+    def next_expiry(self, project_name, repository_name):
+        """
+        Earliest time a chunk becomes leasable again: the lease expiry of a chunk
+        another worker holds or the end of a released chunk's backoff. None when
+        no chunk is waiting.
+        """
+        return self.conn.execute(
+            'SELECT MIN(lease_until) FROM chunks WHERE project_name = ? AND repository_name = ? '
+            "AND status IN ('pending', 'leased')",
+            (project_name, repository_name)
+        ).fetchone()[0]
+
+    def status(self, project_name, repository_name):
+        counts = dict(self.conn.execute(
+            'SELECT status, COUNT(*) FROM chunks WHERE project_name = ? AND repository_name = ? GROUP BY status',
+            (project_name, repository_name)
+        ).fetchall())
+        return {status: counts.get(status, 0) for status in ('pending', 'leased', 'done', 'failed')}
+
+    def close(self):
+        self.conn.close()
+
+
+class OwnershipIndex:
+    """
+    Per-directory contributor counters for --ownership_index, kept in --state_dir
+    and updated from the commit documents of every run.
+
+    Counters use forward decay: n changed lines at time t add n * 2^(t / half_life)
+    to the author's weight in each directory above the file (up to depth levels),
+    stored as log2 so the sums never overflow. At time T the decayed weight is
+    that sum times 2^(-T / half_life), so the result does not depend on the order
+    in which commits are seen. Every commit is counted once per project/repository,
+    whether it comes from git or from the commit cache.
+    """
+
+    def __init__(self, path, half_life_days=180.0, depth=3):
+        self.half_life = half_life_days * 24 * 60 * 60
+        self.depth = depth
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.create_function('logaddexp2', 2, lambda a, b: float(np.logaddexp2(a, b)), deterministic=True)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS ownership_meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS ownership_commits ('
+            'project_name TEXT, repository_name TEXT, sha TEXT, '
+            'PRIMARY KEY (project_name, repository_name, sha))'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS ownership ('
+            'project_name TEXT, repository_name TEXT, directory TEXT, author TEXT, '
+            'log_weight REAL, lines INTEGER, commits INTEGER, last_date INTEGER, '
+            'PRIMARY KEY (project_name, repository_name, directory, author))'
+        )
+        self.check_settings()
+        # Written by save() in one short transaction, so analyzers of a --manifest
+        # run sharing the file do not hold its lock while they analyse.
+        self.pending_commits = set()
+        # (project, repository, directory, author) -> [log_weight, lines, commits, last_date]
+        self.pending = {}
+
+    def check_settings(self):
+        """
+        Weights collected with another half-life or depth cannot be combined with
+        new ones; they are dropped and rebuilt from the commits analysed from now on.
+        """
+        settings = json.dumps({'half_life': self.half_life, 'depth': self.depth})
+        row = self.conn.execute("SELECT value FROM ownership_meta WHERE key = 'settings'").fetchone()
+        if row is not None and row[0] != settings:
+            print("Warning: Ownership settings changed; discarding the collected ownership counters")
+            self.conn.execute('DELETE FROM ownership')
+            self.conn.execute('DELETE FROM ownership_commits')
+        self.conn.execute("INSERT OR REPLACE INTO ownership_meta VALUES ('settings', ?)", (settings,))
+        self.conn.commit()
+
+    def directories(self, path):
+        return self.directory_levels(path.split('/')[:-1])
+
+    def directory_levels(self, parts):
+        return ['.'] + ['/'.join(parts[:level]) for level in range(1, min(len(parts), self.depth) + 1)]
+
+    def add(self, doc):
+        """
+        Counts a commit document; returns False when it was already counted.
+        """
+        project_name, repository_name = doc['project_name'], doc['repository_name']
+        commit = (project_name, repository_name, doc['sha'])
+        if commit in self.pending_commits or self.conn.execute(
+            'SELECT 1 FROM ownership_commits WHERE project_name = ? AND repository_name = ? AND sha = ?', commit
+        ).fetchone():
+            return False
+        self.pending_commits.add(commit)
+
+        if doc.get('directory_lines') is not None:
+            # A summarised mega-commit lists only its top files; its lines per
+            # parent directory cover all of them.
+            changes = ((directory.split('/') if directory else [], lines)
+                       for directory, lines in doc['directory_lines'].items())
+        else:
+            changes = ((stat['file'].split('/')[:-1], stat['insertions'] + stat['deletions']) for stat in doc['files'])
+        lines_by_directory = defaultdict(int)
+        for parts, lines in changes:
+            if lines:
+                for directory in self.directory_levels(parts):
+                    lines_by_directory[directory] += lines
+
+        date = doc['commit_date']
+        for directory, lines in lines_by_directory.items():
+            log_weight = math.log2(lines) + date / self.half_life
+            key = (project_name, repository_name, directory, doc['author'])
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = [log_weight, lines, 1, date]
+            else:
+                entry[0] = float(np.logaddexp2(entry[0], log_weight))
+                entry[1] += lines
+                entry[2] += 1
+                entry[3] = max(entry[3], date)
+        return True
+
+    def save(self):
+        self.conn.executemany('INSERT INTO ownership_commits VALUES (?, ?, ?)', self.pending_commits)
+        self.conn.executemany(
+            'INSERT INTO ownership VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (project_name, repository_name, directory, author) DO UPDATE SET '
+            'log_weight = logaddexp2(log_weight, excluded.log_weight), '
+            'lines = lines + excluded.lines, commits = commits + excluded.commits, '
+            'last_date = max(last_date, excluded.last_date)',
+            [key + tuple(entry) for key, entry in self.pending.items()]
+        )
+        self.conn.commit()
+        self.pending_commits = set()
+        self.pending = {}
+
+    def documents(self, project_name, repository_name, now, top_n=10):
+        """
+        Yields one ownership document per directory of a project/repository, with
+        the shares of the decayed weights as of now.
+        """
+        rows = self.conn.execute(
+            'SELECT directory, author, log_weight, lines, commits, last_date FROM ownership '
+            'WHERE project_name = ? AND repository_name = ? ORDER BY directory',
+            (project_name, repository_name)
+        )
+        directory, contributors = None, []
+        for row in rows:
+            if row[0] != directory and contributors:
+                yield self.document(project_name, repository_name, directory, contributors, now, top_n)
+                contributors = []
+            directory = row[0]
+            contributors.append(row[1:])
+        if contributors:
+            yield self.document(project_name, repository_name, directory, contributors, now, top_n)
+
+    def document(self, project_name, repository_name, directory, contributors, now, top_n):
+        log_weights = np.array([contributor[1] for contributor in contributors])
+        # Relative to the largest weight, so shares survive any amount of decay.
+        relative = np.exp2(log_weights - log_weights.max())
+        shares = relative / relative.sum()
+        recent_lines = np.exp2(log_weights - now / self.half_life)
+        order = np.argsort(-shares, kind='stable')
+        # Smallest number of authors holding at least half of the recent changes.
+        bus_factor = int(np.searchsorted(np.cumsum(shares[order]), 0.5 - 1e-9) + 1)
+
+        top = []
+        for i in order[:top_n]:
+            author, _, lines, commits, last_date = contributors[i]
+            top.append({
+                'author': author,
+                'share': round(float(shares[i]), 4),
+                'recent_lines': round(float(recent_lines[i]), 2),
+                'lines': lines,
+                'commits': commits,
+                'last_commit_date': datetime.fromtimestamp(last_date).isoformat()
+            })
+        return {
+            'project_name': project_name,
+            'repository_name': repository_name,
+            'directory': directory,
+            'depth': 0 if directory == '.' else directory.count('/') + 1,
+            'authors': len(contributors),
+            'bus_factor': bus_factor,
+            'top_contributor': top[0]['author'],
+            'top_share': top[0]['share'],
+            'recent_lines': round(float(recent_lines.sum()), 2),
+            'lines': sum(contributor[2] for contributor in contributors),
+            'commits': sum(contributor[3] for contributor in contributors),
+            'last_commit_date': datetime.fromtimestamp(max(c[4] for c in contributors)).isoformat(),
+            'contributors': top,
+            'date': datetime.fromtimestamp(now).isoformat()
+        }
+
+    def close(self):
+        # Counts that were not saved (failed run) are dropped with their commits.
+        self.conn.close()
+
+
+class ChurnHotspots:
+    """
+    Sliding window of per-path churn for --hotspots: changed lines, commits and
+    authors of every path over the window_days days up to the newest commit
+    seen. Changes are kept in one bucket per day next to running totals; when
+    the window moves, the buckets that fall out are subtracted from the totals
+    and dropped, so every change is added and expired once. Commits may arrive
+    in any order; those already older than the window are ignored.
+
+    Summarised mega-commits (files_summarized) only list their top files, so
+    only those are counted; the number of such commits in the window is kept
+    so reports can say how much churn they leave out.
+    """
+    BUCKET_SECONDS = 24 * 60 * 60
+
+    def __init__(self, window_days=21):
+        self.window = window_days
+        self.buckets = {}  # day -> {path: [lines, commits, {author: commits}]}
+        self.totals = {}  # path -> [lines, commits, {author: commits}]
+        self.latest = None  # newest day seen
+        self.summarized = {}  # day -> summarised mega-commits
+
+    @staticmethod
+    def count(counters, path, lines, author):
+        entry = counters.get(path)
+        if entry is None:
+            entry = counters[path] = [0, 0, {}]
+        entry[0] += lines
+        entry[1] += 1
+        entry[2][author] = entry[2].get(author, 0) + 1
+
+    def add(self, doc):
+        day = doc['commit_date'] // self.BUCKET_SECONDS
+        if self.latest is None or day > self.latest:
+            self.advance(day)
+        if day <= self.latest - self.window:
+            return
+        if doc.get('files_summarized'):
+            self.summarized[day] = self.summarized.get(day, 0) + 1
+        bucket = self.buckets.setdefault(day, {})
+        for stat in doc['files']:
+            lines = stat['insertions'] + stat['deletions']
+            self.count(bucket, stat['file'], lines, doc['author'])
+            self.count(self.totals, stat['file'], lines, doc['author'])
+
+    def advance(self, day):
+        self.latest = day
+        # At most window + 1 buckets exist, so this scan does not grow with history.
+        for expired in [d for d in self.summarized if d <= day - self.window]:
+            del self.summarized[expired]
+        for expired in [d for d in self.buckets if d <= day - self.window]:
+            for path, (lines, commits, authors) in self.buckets.pop(expired).items():
+                total = self.totals[path]
+                total[0] -= lines
+                total[1] -= commits
+                if total[1] == 0:
+                    del self.totals[path]
+                    continue
+                for author, author_commits in authors.items():
+                    remaining = total[2][author] - author_commits
+                    if remaining:
+                        total[2][author] = remaining
+                    else:
+                        del total[2][author]
+
+    def summarized_commits(self):
+        return sum(self.summarized.values())
+
+    def window_bounds(self):
+        end = (self.latest + 1) * self.BUCKET_SECONDS
+        return end - self.window * self.BUCKET_SECONDS, end
+
+    def top(self, k):
+        """
+        The k paths with the most commits in the window, then the most changed
+        lines; ties go to the first path name, so the order of commits does not matter.
+        """
+        ranked = heapq.nsmallest(k, self.totals.items(), key=lambda item: (-item[1][1], -item[1][0], item[0]))
+        return [
+            {
+                'file': path,
+                'commits': commits,
+                'lines': lines,
+                'authors': len(authors),
+                'top_author': max(authors.items(), key=lambda item: item[1])[0]
+            }
+            for path, (lines, commits, authors) in ranked
+        ]
+
+
+class Profiler:
+    """
+    Counts and times git subprocesses by command kind, analysis stages and
+    per-commit latency for --profile. When disabled every hook is a no-op.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.git = {}
+        self.stages = {}
+        self.latencies = array('d')
+
+    def git_call(self, kind, seconds, processes=1, requests=1):
+        """
+        Records git work: processes launched, requests served (one per launch,
+        or one per lookup on a long-lived co-process) and seconds spent waiting.
+        """
+        if not self.enabled:
+            return
+        entry = self.git.setdefault(kind, {'processes': 0, 'requests': 0, 'seconds': 0.0})
+        entry['processes'] += processes
+        entry['requests'] += requests
+        entry['seconds'] += seconds
+
+    def add_stage(self, name, seconds, count=1):
+        if not self.enabled:
+            return
+        entry = self.stages.setdefault(name, {'count': 0, 'seconds': 0.0})
+        entry['count'] += count
+        entry['seconds'] += seconds
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - started)
+
+    def commit(self, seconds):
+        if self.enabled:
+            self.latencies.append(seconds)
+
+    def state(self):
+        """
+        Returns the collected numbers as plain data, e.g. to send them from a
+        worker process back to the coordinator.
+        """
+        return {'git': self.git, 'stages': self.stages, 'latencies': self.latencies}
+
+    def merge(self, state):
+        for kind, entry in state['git'].items():
+            self.git_call(kind, entry['seconds'], entry['processes'], entry['requests'])
+        for name, entry in state['stages'].items():
+            self.add_stage(name, entry['seconds'], entry['count'])
+        self.latencies.extend(state['latencies'])
+
+    def reset(self):
+        self.git = {}
+        self.stages = {}
+        self.latencies = array('d')
+
+    def summary(self, wall_seconds, commits, sink=None):
+        latencies = sorted(self.latencies)
+
+        def percentile(q):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+        summary = {
+            'wall_seconds': round(wall_seconds, 3),
+            'commits': commits,
+            'commits_per_second': round(commits / wall_seconds, 2) if wall_seconds else 0.0,
+            'commit_latency_ms': {
+                'analysed': len(latencies),
+                'p50': round(percentile(0.50) * 1000, 3),
+                'p95': round(percentile(0.95) * 1000, 3),
+                'max': round(latencies[-1] * 1000, 3) if latencies else 0.0
+            },
+            'git': {
+                kind: dict(entry, seconds=round(entry['seconds'], 3))
+                for kind, entry in sorted(self.git.items())
+            },
+            'stages': {
+                name: dict(entry, seconds=round(entry['seconds'], 3))
+                for name, entry in sorted(self.stages.items())
+            }
+        }
+        if sink is not None:
+            summary['stages']['indexing'] = {
+                'count': sink.flushes,
+                'documents': sink.indexed + sink.failed,
+                'seconds': round(sink.flush_seconds, 3)
+            }
+        return summary
+
+
+class GitObjectReader:
+    """
+    Long-lived `git cat-file --batch` co-process for one repository. Commit
+    objects are requested by writing their SHA to the pipe and parsed from the
+    raw object, so a lookup costs no process launch.
+    """
+
+    def __init__(self, repo_path, profiler=None):
+        self.profiler = profiler or Profiler()
+        self.proc = subprocess.Popen(
+            ['git', 'cat-file', '--batch'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=repo_path
+        )
+        self.profiler.git_call('cat-file', 0.0, processes=1, requests=0)
+
+    def read_object(self, sha):
+        """
+        Returns (type, raw bytes) of an object, or None when it does not exist.
+        """
+        started = time.perf_counter()
+        try:
+            return self._read_object(sha)
+        finally:
+            self.profiler.git_call('cat-file', time.perf_counter() - started, processes=0)
+
+    def _read_object(self, sha):
+        self.proc.stdin.write(sha.encode('utf-8') + b'\n')
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline().split()
+        if len(header) != 3:
+            # "<sha> missing" / "<sha> ambiguous"
+            return None
+        size = int(header[2])
+        data = self.proc.stdout.read(size)
+        self.proc.stdout.read(1)  # trailing newline
+        return header[1].decode('ascii'), data
+
+    def read_commit(self, sha):
+        """
+        Returns a dictionary with the commit hash, author name, author email,
+        committer date (Unix timestamp), subject and parent hashes, matching
+        git's %an, %ae, %ct, %s and %P placeholders.
+        """
+        obj = self.read_object(sha)
+        if obj is None or obj[0] != 'commit':
+            return None
+        raw = obj[1].decode('utf-8', errors='replace')
+        headers, _, message = raw.partition('\n\n')
+
+        commit = {'hash': sha, 'author': '', 'email': '', 'date': 0, 'message': '', 'parents': []}
+        for line in headers.split('\n'):
+            if line.startswith(' '):
+                continue  # continuation of a multi-line header such as gpgsig
+            key, _, value = line.partition(' ')
+            if key == 'parent':
+                commit['parents'].append(value)
+            elif key == 'author':
+                commit['author'], commit['email'], _ = self.parse_identity(value)
+            elif key == 'committer':
+                commit['date'] = self.parse_identity(value)[2]
+
+        # %s: the first paragraph of the message, folded into a single line.
+        paragraph = []
+        for line in message.split('\n'):
+            if line.strip():
+                paragraph.append(line.rstrip())
+            elif paragraph:
+                break
+        commit['message'] = ' '.join(paragraph).strip()
+        return commit
+
+    @staticmethod
+    def parse_identity(value):
+        """
+        Splits "Name <email> timestamp tz" into (name, email, timestamp).
+        """
+        lt = value.find('<')
+        gt = value.rfind('>')
+        name = value[:lt].strip() if lt >= 0 else ''
+        email = value[lt + 1:gt] if lt >= 0 and gt > lt else ''
+        rest = value[gt + 1:].split()
+        timestamp = int(rest[0]) if rest and rest[0].lstrip('-').isdigit() else 0
+        return name, email, timestamp
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.proc.stdout.close()
+
+
+class BulkSink:
+    """
+    Indexes documents to Elasticsearch from a background thread using the
+    streaming bulk helper, so git extraction and indexing overlap.
+
+    Documents wait in a bounded queue (send blocks when it is full) and are
+    flushed when flush_size documents are buffered or flush_interval seconds
+    have passed since the first buffered document. Failed items are reported
+    individually and counted; they never stop the run.
+    """
+
+    _CLOSE = object()
+
+    def __init__(self, es, index_name, flush_size=500, flush_interval=5.0, queue_size=2000):
+        self.es = es
+        self.index_name = index_name
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.indexed = 0
+        self.failed = 0
+        self.failed_by_source = defaultdict(int)
+        self.flushes = 0
+        self.flush_seconds = 0.0
+        self.thread = threading.Thread(target=self._worker, name='es-bulk-sink', daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def from_args(cls, es, args):
+        return cls(
+            es,
+            args.index_name,
+            flush_size=args.bulk_size,
+            flush_interval=args.flush_interval,
+            queue_size=args.bulk_queue_size
+        )
+
+    def send(self, doc_id, doc, source=None, index_name=None):
+        """
+        Queues a document. source identifies the producer (e.g. project/repository)
+        so failures can be attributed when several analyzers share the sink.
+        """
+        self.queue.put((source, {
+            '_index': index_name or self.index_name,
+            '_id': doc_id,
+            '_source': dumps_document(doc)
+        }))
+
+    def update(self, doc_id, fields, index_name=None, source=None):
+        """
+        Queues a partial update that only rewrites the given fields of a document.
+        """
+        self.queue.put((source, {
+            '_op_type': 'update',
+            '_index': index_name or self.index_name,
+            '_id': doc_id,
+            'doc': fields
+        }))
+
+    def close(self):
+        """
+        Flushes everything still buffered and waits for the worker to finish.
+        """
+        self.queue.put(self._CLOSE)
+        self.thread.join()
+        print(f"Bulk sink: {self.indexed} documents indexed, {self.failed} failed")
+
+    def _worker(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is self._CLOSE:
+                self._flush(batch)
+                return
+            if item is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+
+            if batch and (len(batch) >= self.flush_size or time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+                deadline = None
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        sources = [source for source, _ in batch]
+        started = time.perf_counter()
+        try:
+            results = streaming_bulk(
+                self.es,
+                [action for _, action in batch],
+                chunk_size=self.flush_size,
+                raise_on_error=False,
+                raise_on_exception=False,
+                max_retries=3
+            )
+            # Results come back in the order the actions were sent.
+            for source, (ok, item) in zip(sources, results):
+                if ok:
+                    self.indexed += 1
+                else:
+                    self.failed += 1
+                    self.failed_by_source[source] += 1
+                    result = next(iter(item.values()))
+                    print(f"Failed to index document {result.get('_id')}: {result.get('error')}")
+        except TransportError as e:
+            self.failed += len(batch)
+            for source in sources:
+                self.failed_by_source[source] += 1
+            print(f"Failed to index {len(batch)} documents: {str(e)}")
+        self.flushes += 1
+        self.flush_seconds += time.perf_counter() - started
+
+
+# Composable index template for --index_name. Keyword fields are only used for
+# filters and terms aggregations, so they skip norms and scoring; the per-file
+# details are kept in _source (for --rescore) without being indexed.
+INDEX_TEMPLATE_PRIORITY = 200
+INDEX_TEMPLATE_SETTINGS = {
+    'refresh_interval': '30s'
+}
+# Keyword field that also keeps the .keyword sub-field of the dynamic mappings,
+# so dashboards built on those (e.g. the author.keyword developer count) work
+# on indices created from the template.
+KEYWORD_FIELD = {'type': 'keyword', 'fields': {'keyword': {'type': 'keyword', 'ignore_above': 256}}}
+INDEX_TEMPLATE_MAPPINGS = {
+    'dynamic_templates': [
+        {'strings_as_keywords': {'match_mapping_type': 'string', 'mapping': dict(KEYWORD_FIELD, ignore_above=1024)}}
+    ],
+    'properties': {
+        'sha': KEYWORD_FIELD,
+        'author': KEYWORD_FIELD,
+        'team': KEYWORD_FIELD,
+        'email': KEYWORD_FIELD,
+        'commit_date': {'type': 'long'},
+        'date': {'type': 'date'},
+        # Same value as date; kept in _source for existing dashboards.
+        'dateString': {'type': 'date', 'index': False},
+        'message': {'type': 'text'},
+        'project_name': KEYWORD_FIELD,
+        'repository_name': KEYWORD_FIELD,
+        'refs': KEYWORD_FIELD,
+        'category': KEYWORD_FIELD,
+        'category_counts': {'properties': {category: {'type': 'integer'} for category in CATEGORIES}},
+        'total_files_changed': {'type': 'integer'},
+        'insertions': {'type': 'integer'},
+        'deletions': {'type': 'integer'},
+        'cefficiency': {'type': 'float'},
+        'commit_impact': {'type': 'float'},
+        'raw_impact': {'type': 'float'},
+        'skipped_files': {'type': 'integer'},
+        'skipped_insertions': {'type': 'integer'},
+        'skipped_deletions': {'type': 'integer'},
+        'files_summarized': {'type': 'boolean'},
+        'files': {'type': 'object', 'enabled': False},
+        'file_extensions': {'type': 'object', 'enabled': False},
+        'directory_lines': {'type': 'object', 'enabled': False}
+    }
+}
+
+# Mappings of the --hotspot_index reports (see GitCommitAnalyzer.report_hotspots).
+HOTSPOT_TEMPLATE_MAPPINGS = {
+    'properties': {
+        'project_name': {'type': 'keyword'},
+        'repository_name': {'type': 'keyword'},
+        'window_start': {'type': 'date'},
+        'window_end': {'type': 'date'},
+        'window_days': {'type': 'integer'},
+        'files_in_window': {'type': 'integer'},
+        'summarized_commits': {'type': 'integer'},
+        'date': {'type': 'date'},
+        'hotspots': {
+            'type': 'nested',
+            'properties': {
+                'file': {'type': 'keyword'},
+                'commits': {'type': 'integer'},
+                'lines': {'type': 'long'},
+                'authors': {'type': 'integer'},
+                'top_author': {'type': 'keyword'}
+            }
+        }
+    }
+}
+
+# Mappings of the --ownership_index documents (see OwnershipIndex.document).
+OWNERSHIP_TEMPLATE_MAPPINGS = {
+    'properties': {
+        'project_name': {'type': 'keyword'},
+        'repository_name': {'type': 'keyword'},
+        'directory': {'type': 'keyword'},
+        'depth': {'type': 'integer'},
+        'authors': {'type': 'integer'},
+        'bus_factor': {'type': 'integer'},
+        'top_contributor': {'type': 'keyword'},
+        'top_share': {'type': 'float'},
+        'recent_lines': {'type': 'float'},
+        'lines': {'type': 'long'},
+        'commits': {'type': 'integer'},
+        'last_commit_date': {'type': 'date'},
+        'date': {'type': 'date'},
+        'contributors': {
+            'type': 'nested',
+            'properties': {
+                'author': {'type': 'keyword'},
+                'share': {'type': 'float'},
+                'recent_lines': {'type': 'float'},
+                'lines': {'type': 'long'},
+                'commits': {'type': 'integer'},
+                'last_commit_date': {'type': 'date'}
+            }
+        }
+    }
+}
+
+
+class IndexManager:
+    """
+    Index administration around a run: installs the index template for
+    --index_name and, for --backfill, relaxes the index settings while a large
+    load runs.
+    """
+    BACKFILL_SETTINGS = {'index.refresh_interval': '-1', 'index.number_of_replicas': 0}
+
+    def __init__(self, es, index_name):
+        self.es = es
+        self.index_name = index_name
+
+    def install_template(self, mappings=INDEX_TEMPLATE_MAPPINGS, shards=None):
+        """
+        Creates or updates the template. It takes effect when the index is
+        (re)created; an existing index keeps its mappings until it is reindexed.
+        Without shards the cluster's default number of primary shards is used.
+        """
+        settings = dict(INDEX_TEMPLATE_SETTINGS)
+        if shards:
+            settings['number_of_shards'] = shards
+        try:
+            self.es.indices.put_index_template(name=f"gitstats-{self.index_name}", body={
+                'index_patterns': [self.index_name],
+                'priority': INDEX_TEMPLATE_PRIORITY,
+                'template': {'settings': settings, 'mappings': mappings}
+            })
+        except TransportError as e:
+            print(f"Warning: Could not install the index template for {self.index_name}: {str(e)}")
+
+    @contextmanager
+    def backfill(self):
+        """
+        Disables refreshes and replicas for the duration of the block. Afterwards
+        the previous settings are restored; when the block succeeded the index is
+        refreshed and force-merged before the replicas come back, so they copy the
+        merged segments instead of merging them again.
+        """
+        try:
+            if not self.es.indices.exists(index=self.index_name):
+                self.es.indices.create(index=self.index_name)
+            response = self.es.indices.get_settings(index=self.index_name, flat_settings=True)
+            current = next(iter(response.values()))['settings']
+            # None resets a setting that was not set explicitly to its default.
+            original = {key: current.get(key) for key in self.BACKFILL_SETTINGS}
+            self.es.indices.put_settings(index=self.index_name, body=self.BACKFILL_SETTINGS)
+        except TransportError as e:
+            print(f"Warning: Could not apply backfill settings to {self.index_name}: {str(e)}")
+            yield
+            return
+
+        print(f"Backfill: refreshes and replicas of {self.index_name} disabled")
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            try:
+                self.es.indices.put_settings(
+                    index=self.index_name,
+                    body={'index.refresh_interval': original['index.refresh_interval']}
+                )
+                if succeeded:
+                    self.es.indices.refresh(index=self.index_name)
+                    started = time.perf_counter()
+                    self.es.indices.forcemerge(index=self.index_name, max_num_segments=1, request_timeout=3600)
+                    print(f"Backfill: force-merged {self.index_name} in {time.perf_counter() - started:.1f}s")
+            finally:
+                self.es.indices.put_settings(
+                    index=self.index_name,
+                    body={'index.number_of_replicas': original['index.number_of_replicas']}
+                )
+                print(f"Backfill: settings of {self.index_name} restored")
+
+    @contextmanager
+    def session(self, args):
+        """
+        Wraps a run: installs the templates unless --no_index_template is given
+        and applies --backfill.
+        """
+        if not args.no_index_template:
+            self.install_template(shards=args.index_shards)
+            if args.ownership_index:
+                IndexManager(self.es, args.ownership_index).install_template(OWNERSHIP_TEMPLATE_MAPPINGS)
+            if args.hotspot_index:
+                IndexManager(self.es, args.hotspot_index).install_template(HOTSPOT_TEMPLATE_MAPPINGS)
+        if args.backfill:
+            with self.backfill():
+                yield
+        else:
+            yield
+
+
+# Analyzer instance owned by each --workers process, created by init_worker.
+_worker_analyzer = None
+
+# Serialises updates of files in --state_dir shared by the analyzers of a --manifest run.
+_state_lock = threading.Lock()
+
+
+def init_worker(args):
+    global _worker_analyzer
+    _worker_analyzer = GitCommitAnalyzer(args, worker=True)
+
+
+def analyze_chunk_in_worker(last_touch, items):
+    docs = _worker_analyzer.analyze_chunk(last_touch, items)
+    profile = _worker_analyzer.profiler.state() if _worker_analyzer.profiler.enabled else None
+    _worker_analyzer.profiler.reset()
+    skipped = dict(_worker_analyzer.skipped)
+    _worker_analyzer.skipped = dict.fromkeys(skipped, 0)
+    return docs, profile, skipped
+
 
 class GitCommitAnalyzer:
-    def __init__(self, args):
+    def __init__(self, args, worker=False, users=None, es=None, teams=None):
+        """
+        worker=True builds an analyzer for a --workers process: it runs git and
+        categorization only, so no Elasticsearch client or cache is opened.
+        users, teams and es let a --manifest run share one user mapping, one
+        teams mapping and one client between the analyzers of all repositories.
+        """
         self.args = args
-        self.users = self.load_users()
-        self.es = self.init_elasticsearch()
+        self.repo_path = args.repo_path
+        self.profiler = Profiler(enabled=bool(args.profile))
+        self.users = users if users is not None else self.load_users(args.names_input_file)
+        # None without --teams_file; documents then carry no team field.
+        self.teams = teams if teams is not None else self.load_teams(args.teams_file)
+        self.identities = IdentityResolver(self.users, self.teams)
+        if worker:
+            self.es = None
+        else:
+            self.es = es if es is not None else self.init_elasticsearch(args)
         self.category_weights = {
             'Refactor': 8,
             'New Work': 6,
             'Help Others': 5,
             'Churn/Rework': 4
         }
-        self.refactor_threshold = 3 * 7 * 24 * 60 * 60  # 3 weeks in seconds
+        self.refactor_threshold = 3 * 7 * 24 * 60 * 60  # 3 weeks in seconds
+        self.efficiency_weights = {
+            'Refactor': 0.9,
+            'New Work': 0.7,
+            'Help Others': 0.6,
+            'Churn/Rework': 0.5
+        }
+        # Logistic normalisation of commit impact (see CommitScorer.impact); the
+        # values --calibrate_impact stored for a repository take precedence.
+        self.impact_steepness = 0.01
+        self.impact_midpoint = 500.0
+        self.impact_calibrations = load_state_file(self.impact_calibration_path()) if args.state_dir else {}
+        # project/repository -> CommitScorer
+        self.scorers = {}
+        # Splits each commit's files between the projects of a monorepo.
+        self.path_map = None
+        if args.path_map:
+            self.path_map = ProjectPathMap.load(args.path_map, (args.project_name, args.repository_name))
+        # Generated, vendored and --exclude'd files, dropped while numstats are parsed.
+        self.excluded_paths = None
+        if args.skip_generated or args.exclude:
+            if args.skip_generated:
+                self.excluded_paths = ExcludedPathMatcher.from_repository(self.run_git_command, args.exclude or [])
+            else:
+                self.excluded_paths = ExcludedPathMatcher([], args.exclude)
+        # files, insertions, deletions left out by excluded_paths, and the commits
+        # that changed nothing else.
+        self.skipped = {'files': 0, 'insertions': 0, 'deletions': 0, 'commits': 0}
+        # path -> (last author, last commit date); only maintained while walking
+        # history oldest-to-newest, otherwise categorize_file asks git per file.
+        self.last_touch = None
+        self.cache = None if worker else self.init_cache()
+        self.sink = None
+        self.commit_count = 0
+        self.document_count = 0
+        # Opened on first use by get_commit_details.
+        self.object_reader = None
+        # Set by analyze for --all_refs/--refs runs.
+        self.ref_containment = None
+        # project/repository -> raw impact percentiles, fed with every commit once.
+        self.impact_sketches = None if worker or not args.state_dir else {}
+        # Opened on first use by add_to_impact_sketch.
+        self.sketched_commits = None
+        # (project, repository) -> ChurnHotspots, fed with every document.
+        self.hotspots = {} if args.hotspots and not worker else None
+        # Per-directory contributor counters, fed with every document.
+        self.ownership = None
+        if args.ownership_index and not worker:
+            os.makedirs(args.state_dir, exist_ok=True)
+            self.ownership = OwnershipIndex(
+                os.path.join(args.state_dir, 'ownership.sqlite'),
+                args.ownership_half_life_days,
+                args.ownership_depth
+            )
 
-    def load_users(self):
+    @staticmethod
+    def load_users(names_input_file):
         """
         Loads user mappings from the file specified by --names_input_file.
-        The file should contain lines with the format:
-            John Doe-U06655
-            Jane Smith-U01233
-            Mark Twain-U02233
-        Returns a dictionary mapping lowercase author names to their alias.
+        Both orders are accepted, one mapping per line:
+            John Doe-U06655     (Name-Alias)
+            U01233-Jane Smith   (UserAlias-CorporateName, as in users.txt.example)
+        The alias is the side without whitespace; when both sides are single
+        words the line is read as Name-Alias. Comment lines start with '#'.
+        Returns a dictionary mapping author names to their alias.
         """
         users = {}
         try:
-            with open(self.args.names_input_file, 'r') as f:
+            with open(names_input_file, 'r', encoding='utf-8') as f:
                 for line in f:
                     line = line.strip()
-                    if not line or '-' not in line:
+                    if not line or line.startswith('#') or '-' not in line:
                         continue
                     # Split into author name and alias; trim whitespace from both parts.
-                    parts = line.split('-', 1)
-                    author = parts[0].strip()
-                    alias = parts[1].strip()
-                    users[alias] = author
+                    author, _, alias = (part.strip() for part in line.partition('-'))
+                    if not author or not alias:
+                        continue
+                    if len(alias.split()) > 1 and len(author.split()) == 1:
+                        author, alias = alias, author
+                    users[author] = alias
             return users
         except FileNotFoundError:
-            print(f"Warning: User mapping file {self.args.names_input_file} not found")
+            print(f"Warning: User mapping file {names_input_file} not found")
+            return {}
+
+    @staticmethod
+    def load_teams(teams_file):
+        """
+        Loads the developer -> team mapping from --teams_file, in the format
+        dora-metrics.py reads ("Team Name-Developer Name", split at the last '-')
+        or as "Developer Name=Team Name". Returns None without a teams file.
+        """
+        if not teams_file:
+            return None
+        teams = {}
+        try:
+            with open(teams_file, 'r', encoding='utf-8') as f:
+                for line_num, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    if '=' in line:
+                        developer, _, team = line.partition('=')
+                    elif '-' in line:
+                        team, _, developer = line.rpartition('-')
+                    else:
+                        print(f"Warning: {teams_file}:{line_num}: expected 'Team Name-Developer Name', got '{line}'")
+                        continue
+                    if developer.strip() and team.strip():
+                        teams[developer.strip()] = team.strip()
+            return teams
+        except FileNotFoundError:
+            print(f"Warning: Teams file {teams_file} not found")
             return {}
 
-    def init_elasticsearch(self):
-        if self.args.elasticsearch_username and self.args.elasticsearch_password:
+    @staticmethod
+    def init_elasticsearch(args):
+        if args.elasticsearch_username and args.elasticsearch_password:
             return Elasticsearch(
-                [self.args.elasticsearch_host],
-                basic_auth=(self.args.elasticsearch_username, self.args.elasticsearch_password)
+                [args.elasticsearch_host],
+                basic_auth=(args.elasticsearch_username, args.elasticsearch_password)
+            )
+        return Elasticsearch([args.elasticsearch_host])
+
+    def analysis_fingerprint(self):
+        """
+        Hash of everything that influences a commit document besides the commit
+        itself. Changing any of these invalidates previously cached documents.
+        """
+        settings = {
+            'version': ANALYZER_VERSION,
+            # The single-pass walk follows renames through the last-touch index,
+            # the per-commit git lookups do not, so the two modes categorize
+            # renamed files differently.
+            'single_pass': bool(self.args.single_pass),
+            'category_weights': self.category_weights,
+            'efficiency_weights': self.efficiency_weights,
+            'impact_steepness': self.impact_steepness,
+            'impact_midpoint': self.impact_midpoint,
+            'impact_calibration': {key: self.impact_calibrations.get(key) for key in self.document_keys()},
+            'path_map': self.path_map.rules if self.path_map else None,
+            'excluded_paths': {
+                'gitattributes': self.excluded_paths.sources,
+                'exclude': self.excluded_paths.exclude_patterns
+            } if self.excluded_paths else None,
+            'refactor_threshold': self.refactor_threshold,
+            'users': self.users,
+            'teams': self.teams,
+            'mega_commit_files': self.args.mega_commit_files,
+            'mega_commit_top_files': self.args.mega_commit_top_files,
+        }
+        return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def init_cache(self):
+        if not self.args.state_dir:
+            return None
+        os.makedirs(self.args.state_dir, exist_ok=True)
+        return CommitCache(os.path.join(self.args.state_dir, 'commit_cache.sqlite'), self.analysis_fingerprint())
+
+    def high_water_mark_path(self):
+        return os.path.join(self.args.state_dir, 'high_water_marks.json')
+
+    def high_water_mark_key(self):
+        return f"{self.args.project_name}/{self.args.repository_name}"
+
+    def load_high_water_marks(self):
+        return load_state_file(self.high_water_mark_path())
+
+    def save_high_water_mark(self, commit_hash):
+        """
+        Records the last processed commit for this project/repository.
+        """
+        update_state_file(self.high_water_mark_path(), self.high_water_mark_key(), commit_hash)
+
+    def impact_sketch_path(self):
+        return os.path.join(self.args.state_dir, 'impact_sketches.json')
+
+    def impact_calibration_path(self):
+        return os.path.join(self.args.state_dir, 'impact_calibration.json')
+
+    def document_keys(self):
+        """
+        "project/repository" of every stream this analyzer writes documents for.
+        """
+        if self.path_map is None:
+            return [self.high_water_mark_key()]
+        return [f"{project_name}/{repository_name}" for project_name, repository_name in self.path_map.keys()]
+
+    def scorer_for(self, project_name, repository_name):
+        """
+        CommitScorer with the impact midpoint/steepness of a project/repository.
+        """
+        key = f"{project_name}/{repository_name}"
+        if key not in self.scorers:
+            calibration = self.impact_calibrations.get(key) or {}
+            self.scorers[key] = CommitScorer(
+                self.category_weights,
+                self.efficiency_weights,
+                calibration.get('steepness', self.impact_steepness),
+                calibration.get('midpoint', self.impact_midpoint)
             )
-        return Elasticsearch([self.args.elasticsearch_host])
+        return self.scorers[key]
+
+    def add_to_impact_sketch(self, doc):
+        if self.sketched_commits is None:
+            self.sketched_commits = SketchedCommits(os.path.join(self.args.state_dir, 'impact_sketches.sqlite'))
+        if not self.sketched_commits.add(doc['project_name'], doc['repository_name'], doc['sha']):
+            return
+        key = f"{doc['project_name']}/{doc['repository_name']}"
+        if key not in self.impact_sketches:
+            self.impact_sketches[key] = ImpactSketch(load_state_file(self.impact_sketch_path()).get(key))
+        self.impact_sketches[key].add(doc['raw_impact'])
+
+    def get_rev_args(self, head):
+        """
+        Returns the git revision arguments for this run. In incremental mode only
+        the commits after the stored high-water mark are walked; without a usable
+        mark (first run, rewritten history) the --since/--until window is used.
+        head is a list of ref tip commits in --all_refs/--refs runs.
+        """
+        window = ['--since', self.args.since, '--until', self.args.until]
+        if isinstance(head, list):
+            window += head
+        if not self.args.incremental:
+            return window
+
+        last = self.load_high_water_marks().get(self.high_water_mark_key())
+        if not last:
+            print(f"No high-water mark for {self.high_water_mark_key()}, using the --since/--until window")
+            return window
+        if isinstance(head, list) or isinstance(last, list):
+            return self.get_refs_rev_args(head, last, window)
+        is_ancestor = subprocess.run(
+            ['git', 'merge-base', '--is-ancestor', last, head],
+            capture_output=True,
+            cwd=self.repo_path
+        )
+        if is_ancestor.returncode != 0:
+            print(f"High-water mark {last[:6]} is not an ancestor of {head[:6]}, using the --since/--until window")
+            return window
+        print(f"Incremental run from {last[:6]} to {head[:6]}")
+        return [f'{last}..{head}']
+
+    def get_refs_rev_args(self, tips, last, window):
+        """
+        Incremental walk over several refs: everything reachable from the current
+        tips but not from the tips recorded by the previous run. Previous tips that
+        no longer exist (deleted branches, rewritten history) are ignored.
+        """
+        if not isinstance(tips, list) or not isinstance(last, list):
+            print("High-water mark was recorded with a different ref selection, using the --since/--until window")
+            return window
+        previous = [commit_hash for commit_hash in last if self.commit_exists(commit_hash)]
+        if not previous:
+            print("None of the previous ref tips exist any more, using the --since/--until window")
+            return window
+        print(f"Incremental run over {len(tips)} ref tips, excluding history of {len(previous)} previous tips")
+        return tips + ['--not'] + previous
+
+    def commit_exists(self, commit_hash):
+        result = subprocess.run(
+            ['git', 'cat-file', '-e', f'{commit_hash}^{{commit}}'],
+            capture_output=True,
+            cwd=self.repo_path
+        )
+        return result.returncode == 0
+
+    def list_refs(self):
+        """
+        Returns {short ref name: commit} for --all_refs (branches, remote-tracking
+        branches and tags) or the --refs patterns. Annotated tags are peeled to
+        their commit; symbolic refs such as origin/HEAD are skipped.
+        """
+        patterns = self.args.refs or ['refs/heads', 'refs/remotes', 'refs/tags']
+        output = self.run_git_command([
+            'git', 'for-each-ref',
+            '--format=%(refname:short)%00%(objectname)%00%(*objectname)%00%(symref)'
+        ] + patterns)
+        tips = {}
+        for line in (output or '').splitlines():
+            name, objectname, peeled, symref = line.split('\0')
+            if not symref:
+                tips[name] = peeled or objectname
+        return tips
 
     def run_git_command(self, cmd):
+        started = time.perf_counter()
         try:
             result = subprocess.run(
                 cmd,
                 capture_output=True,
                 text=True,
                 check=True,
-                timeout=10
+                cwd=self.repo_path
             )
             return result.stdout.strip()
         except subprocess.SubprocessError as e:
             print(f"Git command failed: {str(e)}")
             return None
+        finally:
+            self.profiler.git_call(cmd[1], time.perf_counter() - started)
 
     def get_commit_details(self, commit_hash):
         """
-        Retrieves details for a given commit hash using Git commands.
+        Retrieves details for a given commit hash from the repository's
+        `git cat-file --batch` reader.
         Returns a dictionary with the commit hash, author name, email, date (Unix timestamp),
         commit message, and parent commit hashes.
         Also maps the author name using the user mapping (if available) so that the author
-        field is replaced with the corresponding alias (e.g. U06655).
+        field is replaced with the corresponding alias (e.g. U06655), and adds the team.
         """
-        details = {
-            'hash': commit_hash,
-            'author': self.run_git_command(['git', 'log', '-1', '--pretty=format:%an', commit_hash]),
-            'email': self.run_git_command(['git', 'log', '-1', '--pretty=format:%ae', commit_hash]),
-            'date': int(self.run_git_command(['git', 'log', '-1', '--pretty=format:%ct', commit_hash])),
-            'message': self.run_git_command(['git', 'log', '-1', '--pretty=format:%s', commit_hash]),
-            'parents': self.run_git_command(['git', 'log', '-1', '--pretty=format:%P', commit_hash]).split(),
-        }
-        
-        # Replace the author name with alias if it exists in the mapping.
-        author = details['author'].strip() if details['author'] else ""
-        if author in self.users:
-            details['author'] = self.users[author]
+        if self.object_reader is None:
+            self.object_reader = GitObjectReader(self.repo_path, self.profiler)
+        details = self.object_reader.read_commit(commit_hash)
+        if details is None:
+            # Not a commit object id (e.g. a ref name); let git resolve it.
+            header = self.run_git_command(['git', 'log', '-1', f'--pretty=format:{LOG_FORMAT}', commit_hash])
+            return self.parse_log_header(header[1:])
+        details['author'], details['team'] = self.identities.resolve(details['author'], details['email'])
         return details
 
+    def map_author(self, author, email=''):
+        """
+        Replaces the author name with alias if it exists in the mapping.
+        """
+        return self.identities.resolve(author, email)[0]
+
+    def numstat_parser(self):
+        if self.path_map is not None:
+            return PartitionedNumstatParser(
+                self.path_map, self.args.mega_commit_files, self.args.mega_commit_top_files, self.excluded_paths
+            )
+        return NumstatParser(self.args.mega_commit_files, self.args.mega_commit_top_files, self.excluded_paths)
+
     def get_file_stats(self, commit_hash):
-        stats = []
-        raw_stats = self.run_git_command(['git', 'show', '--numstat', '--pretty=', commit_hash])
-        for line in raw_stats.split('\n'):
-            if not line.strip():
-                continue
-            parts = line.split('\t')
-            if len(parts) >= 3 and parts[0].isdigit() and parts[1].isdigit():
-                stats.append({
-                    'insertions': int(parts[0]),
-                    'deletions': int(parts[1]),
-                    'file': parts[2]
-                })
-        return stats
+        """
+        Streams `git show --numstat` for a commit. Returns a list of file stats, or
+        a FileStatsSummary when the commit changes more than --mega_commit_files files
+        (with --path_map, a dict of those per project).
+        """
+        cmd = ['git', 'show', '-z', '--numstat', '--pretty=', commit_hash]
+        started = time.perf_counter()
+        parser = self.numstat_parser()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=self.repo_path)
+        try:
+            for token in iter_nul_tokens(proc.stdout):
+                parser.feed(token)
+        finally:
+            proc.stdout.close()
+            if proc.wait() != 0:
+                print(f"Git command failed: {' '.join(cmd)} exited with {proc.returncode}")
+            self.profiler.git_call('show', time.perf_counter() - started)
+        return parser.result()
 
-    def categorize_file(self, file_stat, commit_author, commit_date, commit_hash, parent_hashes):
-        file_path = file_stat['file']
-        insertions = file_stat['insertions']
-        deletions = file_stat['deletions']
+    def parse_log_header(self, header):
+        """
+        Parses a LOG_FORMAT header into the same structure get_commit_details returns.
+        """
+        commit_hash, author, email, date, parents, message = header.split(LOG_FIELD_SEP, 5)
+        alias, team = self.identities.resolve(author, email)
+        return {
+            'hash': commit_hash,
+            'author': alias,
+            'team': team,
+            'email': email,
+            'date': int(date),
+            'message': message.strip(),
+            'parents': parents.split(),
+        }
+
+    def iter_log_commits(self, rev_args):
+        """
+        Walks history with a single `git log --numstat -z` process and yields
+        (details, file_stats) for each commit as soon as its entries are read.
+        This replaces the per-commit get_commit_details/get_file_stats calls.
+        """
+        cmd = ['git', 'log', '-z', '--numstat', f'--pretty=format:{LOG_FORMAT}'] + rev_args
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, cwd=self.repo_path)
+        details = None
+        parser = None
+        # Time spent reading and parsing the stream, excluding the time the
+        # consumer spends on each yielded commit.
+        reading = 0.0
+        started = time.perf_counter()
+        try:
+            for token in iter_nul_tokens(proc.stdout):
+                if token.startswith(LOG_RECORD_SEP):
+                    if details:
+                        record = details, parser.result()
+                        reading += time.perf_counter() - started
+                        yield record
+                        started = time.perf_counter()
+                    header, _, token = token[1:].partition('\n')
+                    details = self.parse_log_header(header)
+                    parser = self.numstat_parser()
+                if parser is not None:
+                    parser.feed(token)
+            if details:
+                record = details, parser.result()
+                reading += time.perf_counter() - started
+                yield record
+                started = time.perf_counter()
+        finally:
+            proc.stdout.close()
+            if proc.wait() != 0:
+                print(f"Git command failed: {' '.join(cmd)} exited with {proc.returncode}")
+            self.profiler.git_call('log', reading + time.perf_counter() - started)
+
+    def lookup_last_touch(self, file_path, parent_hash):
+        """
+        Returns (author, date) of the last commit reachable from parent_hash that
+        touched file_path, or None when the file has no history.
+        """
+        log_cmd = [
+            'git', 'log', '-1', '--pretty=format:%an%x1f%ae%x1f%ct',
+            parent_hash, '--', file_path
+        ]
+        log_output = self.run_git_command(log_cmd)
+        if log_output:
+            try:
+                author, email, date = log_output.split(LOG_FIELD_SEP)
+                return self.map_author(author.strip(), email), int(date)
+            except ValueError:
+                pass
+        return None
+
+    def get_last_touch(self, file_stat, parent_hash):
+        """
+        Returns the last (author, date) for a file before the current commit.
+        When the last-touch index is active, the answer comes from the index and
+        renamed files are looked up under their previous path. A path missing from
+        the index (last touched before the walked range) is resolved from git once
+        and then kept in the index.
+        """
+        if self.last_touch is None:
+            return self.lookup_last_touch(file_stat['file'], parent_hash) if parent_hash else None
+
+        path = file_stat.get('previous_file', file_stat['file'])
+        if path not in self.last_touch:
+            self.last_touch[path] = self.lookup_last_touch(path, parent_hash) if parent_hash else None
+        return self.last_touch[path]
+
+    def update_last_touch(self, file_stats, author, date):
+        """
+        Records the current commit as the last touch of every changed path,
+        moving index entries along with renames.
+        """
+        for path, previous_path in iter_changed_paths(file_stats):
+            if previous_path:
+                self.last_touch.pop(previous_path, None)
+            self.last_touch[path] = (author, date)
 
+    def categorize_file(self, file_stat, commit_author, commit_date, commit_hash, parent_hashes):
         # Get last modification info from parent commit
-        last_author = None
-        last_date = None
         parent_hash = parent_hashes[0] if parent_hashes else None
+        last_touch = self.get_last_touch(file_stat, parent_hash)
+        return self.categorize_change(
+            file_stat['insertions'], file_stat['deletions'], last_touch, commit_author, commit_date
+        )
 
-        if parent_hash:
-            # Get last author and date for this file before current commit
-            log_cmd = [
-                'git', 'log', '-1', '--pretty=format:%an %ct',
-                parent_hash, '--', file_path
-            ]
-            log_output = self.run_git_command(log_cmd)
-            if log_output:
-                try:
-                    parts = log_output.rsplit(' ', 1)
-                    last_author = parts[0].strip()
-                    last_date = int(parts[1])
-                except (ValueError, IndexError):
-                    pass
+    def categorize_change(self, insertions, deletions, last_touch, commit_author, commit_date):
+        """
+        Categorizes a change of insertions/deletions lines, given the (author, date)
+        of the previous change to the same path (None when it has no history).
+        """
+        last_author = None
+        last_date = None
+        if last_touch:
+            last_author, last_date = last_touch
 
         if not last_author or not last_date:
             # New file with no history
@@ -149,128 +2465,188 @@ class GitCommitAnalyzer:
             if last_author != commit_author:
                 return 'Help Others'
             else:
-                # Check if changes are purely additive
-                diff_cmd = [
-                    'git', 'diff', '--unified=0',
-                    parent_hash, commit_hash, '--', file_path
-                ]
-                diff_output = self.run_git_command(diff_cmd)
-                has_additions = False
-                has_deletions = False
-
-                for line in diff_output.split('\n'):
-                    if line.startswith('+') and not line.startswith('+++'):
-                        has_additions = True
-                    elif line.startswith('-') and not line.startswith('---'):
-                        has_deletions = True
-
-                if has_additions and not has_deletions:
+                # Purely additive changes are New Work. The numstat columns already
+                # tell us whether the file had any deleted lines in this commit.
+                if insertions > 0 and deletions == 0:
                     return 'New Work'
                 else:
                     return 'Churn/Rework'
 
-    def determine_commit_category(self, counts):
-        weighted = {k: counts.get(k, 0) * v for k, v in self.category_weights.items()}
-        max_category = max(weighted, key=weighted.get)
-        return max_category
+    def categorize_summary(self, summary, commit_author, commit_date, parent_hashes):
+        """
+        Categorizes a mega-commit per directory instead of per file: each directory
+        is categorized once from its own totals and last touch, and counts for as
+        many files as it contains.
+        """
+        parent_hash = parent_hashes[0] if parent_hashes else None
+        category_counts = defaultdict(int)
+        for directory, (files, insertions, deletions) in summary.directories.items():
+            last_touch = self.lookup_last_touch(directory or '.', parent_hash) if parent_hash else None
+            category = self.categorize_change(insertions, deletions, last_touch, commit_author, commit_date)
+            category_counts[category] += files
+        return category_counts
 
-    def calculate_efficiency(self, category, insertions, deletions):
-        weights = {
-            'Refactor': 0.9,
-            'New Work': 0.7,
-            'Help Others': 0.6,
-            'Churn/Rework': 0.5
+    def score_commit(self, category_counts, insertions, deletions, file_stats, project_name, repository_name):
+        """
+        Returns the category, cefficiency, commit_impact and raw_impact fields for
+        one commit; a thin wrapper around the batch scoring engine.
+        """
+        block = ScoreBlock()
+        block.add(insertions, deletions, file_stats, category_counts)
+        categories, efficiency, impact, raw_impact = self.scorer_for(project_name, repository_name).score(block)
+        return {
+            'category': CATEGORIES[categories[0]],
+            'cefficiency': float(efficiency[0]),
+            'commit_impact': float(impact[0]),
+            'raw_impact': round(float(raw_impact[0]), 2)
         }
-        total = insertions + deletions
-        if total == 0:
-            return 0.0
-        return round((insertions / total) * weights.get(category, 0.5)*100, 2)
 
-    def calculate_commit_impact(self, file_stats):
+    def score_documents(self, docs):
         """
-        Calculates the commit impact based on file changes using a logistic scaling
-        to smoothly normalize the raw impact into a value between 1.0 and 100.0.
-        
-        Impact is computed by summing for each file:
-            (insertions + deletions) * file_type_weight
-        and then adding a bonus based on the number of changed files.
-        
-        The raw impact value is then mapped to the [1.0, 100.0] range using a logistic function.
+        Recomputes category, cefficiency and commit_impact for a batch of stored
+        documents from the inputs they carry. The category is only recomputed for
+        documents that store their category_counts. Returns one dict of scores per
+        document.
         """
-        raw_impact = 0.0
-
-        # Define file type weights
-        document_extensions = {'doc', 'docx', 'ebook', 'log', 'md', 'msg', 'odt', 'org', 'pages', 'pdf', 'rtf', 'rst', 'tex', 'txt', 'wpd', 'wps'}
-        code_extensions = {'1.ada', '2.ada', 'ada', 'adb', 'ads', 'asm', 'bas', 'bash', 'bat', 'c', 'c++', 'cbl', 'cc', 'class', 'clj', 'cob', 'cpp', 'cs', 'csh', 'cxx', 'd', 'diff', 'e', 'el', 'f', 'f77', 'f90', 'fish', 'for', 'fth', 'ftn', 'go', 'groovy', 'h', 'hh', 'hpp', 'hs', 'html', 'htm', 'hxx', 'java', 'js', 'jsx', 'jsp', 'ksh', 'kt', 'lhs', 'lisp', 'lua', 'm', 'm4', 'nim', 'patch', 'php', 'pl', 'po', 'pp', 'py', 'r', 'rb', 'rs', 's', 'scala', 'sh', 'sql', 'swg', 'swift', 'v', 'vb', 'vcxproj', 'xcodeproj', 'xml', 'zsh'}
-        config_extensions = {'doc', 'docx', 'ebook', 'log', 'md', 'msg', 'odt', 'org', 'pages', 'pdf', 'rtf', 'rst', 'tex', 'txt', 'wpd', 'wps'}
+        # One block per project/repository, as each may have its own calibration.
+        groups = defaultdict(list)
+        for position, doc in enumerate(docs):
+            groups[(doc.get('project_name'), doc.get('repository_name'))].append(position)
 
-        for stat in file_stats:
-            file_path = stat['file']
-            # Get the file extension (if any)
-            ext = file_path.rsplit('.', 1)[-1].lower() if '.' in file_path else ''
-            if ext in document_extensions:
-                weight = 0.3
-            elif ext in config_extensions:
-                weight = 0.7
-            elif ext in code_extensions:
-                weight = 0.6
-            else:
-                # Default weight for other file types
-                weight = 0.3
-
-            # Impact based on the sum of changes multiplied by the file weight
-            #file_impact = (stat['insertions'] + stat['deletions']) * weight
-            file_impact = (stat['insertions'] + stat['deletions']) * weight
-            raw_impact += file_impact
-
-        # Additionally, incorporate the number of changed files to increase impact
-        raw_impact += len(file_stats)*raw_impact
-
-        # Normalize raw impact using a logistic (sigmoid) function.
-        # The logistic function maps the raw impact (which is unbounded) smoothly to [1.0, 100.0].
-        #
-        # We'll use a formulation:
-        #     normalized = lower_bound + (upper_bound - lower_bound) / (1 + exp(-k*(raw_impact - x0)))
-        #
-        # where:
-        #     - lower_bound = 1.0 and upper_bound = 100.0,
-        #     - k controls the steepness of the curve,
-        #     - x0 is the midpoint of the raw impact scale.
-        #
-        # Adjust k and x0 based on the expected range of raw_impact in your repository.
-        lower_bound = 1.0
-        upper_bound = 100.0
-        k = 0.01  # steepness parameter (adjust as needed)
-        x0 = 500.0  # midpoint parameter (adjust as needed)
+        scores = [None] * len(docs)
+        for key, positions in groups.items():
+            block = ScoreBlock()
+            for position in positions:
+                block.add_document(docs[position])
+            categories, efficiency, impact, raw_impact = self.scorer_for(*key).score(block)
+            for position, code, cefficiency, commit_impact, raw in zip(positions, categories, efficiency, impact, raw_impact):
+                scores[position] = {
+                    'category': CATEGORIES[code] if code < len(CATEGORIES) else docs[position]['category'],
+                    'cefficiency': float(cefficiency),
+                    'commit_impact': float(commit_impact),
+                    'raw_impact': round(float(raw), 2)
+                }
+        return scores
 
-        # Compute the logistic function value.
-        normalized = lower_bound + (upper_bound - lower_bound) / (1 + math.exp(-k * (raw_impact - x0)))
-        return round(normalized, 1)
-
-    def process_commit(self, commit_hash):
-        details = self.get_commit_details(commit_hash)
+    def process_commit(self, commit_hash, details=None, file_stats=None):
+        """
+        Builds the Elasticsearch document for a commit. When details and file_stats
+        are already known (single-pass mode) no git commands are run for them.
+        """
+        if details is None:
+            details = self.get_commit_details(commit_hash)
         if len(details['parents']) >= 2:
             return None  # Skip merge commits
 
-        file_stats = self.get_file_stats(commit_hash)
+        if file_stats is None:
+            file_stats = self.get_file_stats(commit_hash)
+        if self.excluded_paths is not None:
+            self.count_skipped(file_stats)
         if not file_stats:
             return None
+        if self.path_map is not None:
+            # One document per monorepo project the commit touches.
+            return [
+                self.process_file_stats(commit_hash, details, stats, project_name, repository_name)
+                for (project_name, repository_name), stats in file_stats.items()
+                if stats
+            ] or None
+        return self.process_file_stats(
+            commit_hash, details, file_stats, self.args.project_name, self.args.repository_name
+        )
+
+    def count_skipped(self, file_stats):
+        """
+        Adds the files the parser left out of a commit to self.skipped.
+        """
+        parts = list(file_stats.values()) if isinstance(file_stats, dict) else [file_stats]
+        skipped = [part.skipped for part in parts if part.skipped]
+        if not skipped:
+            return
+        for files, insertions, deletions in skipped:
+            self.skipped['files'] += files
+            self.skipped['insertions'] += insertions
+            self.skipped['deletions'] += deletions
+        if not any(parts):
+            self.skipped['commits'] += 1
+
+    def process_file_stats(self, commit_hash, details, file_stats, project_name, repository_name):
+        """
+        Builds the document of a commit's changes to one project/repository.
+        """
+        if isinstance(file_stats, FileStatsSummary):
+            doc = self.process_mega_commit(commit_hash, details, file_stats, project_name, repository_name)
+        else:
+            doc = self.process_file_list(commit_hash, details, file_stats, project_name, repository_name)
+        if self.excluded_paths is not None:
+            skipped = file_stats.skipped or (0, 0, 0)
+            doc['skipped_files'], doc['skipped_insertions'], doc['skipped_deletions'] = skipped
+        return doc
+
+    def process_file_list(self, commit_hash, details, file_stats, project_name, repository_name):
+        """
+        Builds the document of a commit whose file stats are listed one by one.
+        """
 
         category_counts = defaultdict(int)
-        for stat in file_stats:
-            category = self.categorize_file(
-                stat,
-                details['author'],
-                details['date'],
-                commit_hash,
-                details['parents']
-            )
-            category_counts[category] += 1
+        with self.profiler.stage('categorization'):
+            for stat in file_stats:
+                category = self.categorize_file(
+                    stat,
+                    details['author'],
+                    details['date'],
+                    commit_hash,
+                    details['parents']
+                )
+                category_counts[category] += 1
+
+        if self.last_touch is not None:
+            self.update_last_touch(file_stats, details['author'], details['date'])
 
-        commit_category = self.determine_commit_category(category_counts)
         total_insertions = sum(s['insertions'] for s in file_stats)
         total_deletions = sum(s['deletions'] for s in file_stats)
 
+        with self.profiler.stage('impact_scoring'):
+            scores = self.score_commit(
+                category_counts, total_insertions, total_deletions, file_stats, project_name, repository_name
+            )
+
+        return self.build_document(
+            commit_hash, details, project_name, repository_name, category_counts,
+            total_insertions, total_deletions, len(file_stats), scores, file_stats
+        )
+
+    def process_mega_commit(self, commit_hash, details, summary, project_name, repository_name):
+        """
+        Builds the document for a commit that changed more than --mega_commit_files
+        files. Categorization runs per directory; efficiency and impact still cover
+        every file. The document lists only the --mega_commit_top_files most changed
+        files, plus per-extension totals.
+        """
+        with self.profiler.stage('categorization'):
+            category_counts = self.categorize_summary(summary, details['author'], details['date'], details['parents'])
+
+        if self.last_touch is not None:
+            self.update_last_touch(summary, details['author'], details['date'])
+
+        with self.profiler.stage('impact_scoring'):
+            scores = self.score_commit(
+                category_counts, summary.insertions, summary.deletions, summary, project_name, repository_name
+            )
+
+        doc = self.build_document(
+            commit_hash, details, project_name, repository_name, category_counts,
+            summary.insertions, summary.deletions, summary.file_count, scores, summary.top_files()
+        )
+        doc['files_summarized'] = True
+        doc['file_extensions'] = summary.extension_totals()
+        # Changed lines of every file by parent directory, so the ownership index
+        # covers the files left out of the list.
+        doc['directory_lines'] = summary.directory_lines()
+        return doc
+
+    def build_document(self, commit_hash, details, project_name, repository_name, category_counts,
+                       insertions, deletions, files_changed, scores, files):
         doc = {
             'sha': commit_hash,
             'author': details['author'],
@@ -279,63 +2655,904 @@ class GitCommitAnalyzer:
             'date': datetime.fromtimestamp(details['date']).isoformat(),
             'dateString': datetime.fromtimestamp(details['date']).isoformat(),
             'message': details['message'],
-            'project_name': self.args.project_name,
-            'repository_name': self.args.repository_name,
-            'total_files_changed': len(file_stats),
-            'insertions': total_insertions,
-            'deletions': total_deletions,
-            'category': commit_category,
-            'cefficiency': self.calculate_efficiency(commit_category, total_insertions, total_deletions),
-            'commit_impact': self.calculate_commit_impact(file_stats),
-            'files': file_stats
+            'project_name': project_name,
+            'repository_name': repository_name,
+            'total_files_changed': files_changed,
+            'insertions': insertions,
+            'deletions': deletions,
+            'category': scores['category'],
+            # Kept so --rescore can re-derive the category when the weights change.
+            'category_counts': dict(category_counts),
+            'cefficiency': scores['cefficiency'],
+            'commit_impact': scores['commit_impact'],
+            # Input of the commit_impact logistic, fed to the per-repository impact sketch.
+            'raw_impact': scores['raw_impact'],
+            'files': files
         }
-
+        if self.teams is not None:
+            # Resolved once per author at ingest, so team filters are term queries.
+            doc['team'] = details['team']
         return doc
 
+    def document_id(self, doc):
+        # A --path_map commit has one document per project.
+        if self.path_map is None:
+            return doc['sha']
+        return f"{doc['sha']}:{doc['project_name']}/{doc['repository_name']}"
+
     def send_to_elasticsearch(self, doc):
-        # print(f"index document {doc}")
-        # print(f"###")
-        # time.sleep(0.1)
+        # Includes the time spent blocked on a full sink queue.
+        with self.profiler.stage('sink_enqueue'):
+            self.sink.send(self.document_id(doc), doc, source=self.high_water_mark_key())
+
+    def timed_process_commit(self, commit_hash, details=None, file_stats=None):
+        started = time.perf_counter()
+        doc = self.process_commit(commit_hash, details, file_stats)
+        self.profiler.commit(time.perf_counter() - started)
+        return doc
+
+    def analyze_commit(self, commit_hash, details=None, file_stats=None):
+        """
+        Returns the document for a commit, reusing the cached document when the
+        commit was already analysed with the current settings.
+        """
+        if self.cache is None:
+            return self.timed_process_commit(commit_hash, details, file_stats)
+
+        hit, doc = self.cache.get(self.args.project_name, self.args.repository_name, commit_hash)
+        if hit:
+            if file_stats is not None and self.excluded_paths is not None:
+                self.count_skipped(file_stats)
+            if doc and self.last_touch is not None:
+                # The index is only kept in single-pass mode, where the full stats are
+                # known; a summarised document would only list the top files.
+                self.update_last_touch(file_stats, details['author'], details['date'])
+            return doc
+
+        doc = self.timed_process_commit(commit_hash, details, file_stats)
+        self.cache.put(self.args.project_name, self.args.repository_name, commit_hash, doc)
+        return doc
+
+    def analyze_chunk(self, last_touch, items):
+        """
+        Analyses a contiguous range of commits inside a worker process.
+        last_touch holds the coordinator's index entries for the paths this range
+        touches, as they were right before its first commit (None when the index
+        is not used). Items marked cached are not analysed again; they only move
+        the index forward, exactly as analyze_commit does on a cache hit.
+        """
+        self.last_touch = last_touch
+        docs = []
+        for commit_hash, details, file_stats, cached in items:
+            if cached:
+                if file_stats is not None and self.excluded_paths is not None:
+                    self.count_skipped(file_stats)
+                if file_stats and self.last_touch is not None:
+                    self.update_last_touch(file_stats, details['author'], details['date'])
+                docs.append(None)
+            else:
+                docs.append(self.timed_process_commit(commit_hash, details, file_stats))
+        return docs
+
+    def index_snapshot(self, chunk):
+        """
+        Copies the index entries a chunk of commits will read, so a worker sees
+        the same last-touch state a serial run would at the start of the chunk.
+        """
+        snapshot = {}
+        for _, _, file_stats in chunk:
+            for paths in iter_changed_paths(file_stats):
+                for path in paths:
+                    if path in self.last_touch:
+                        snapshot[path] = self.last_touch[path]
+        return snapshot
+
+    def iter_chunks(self, records):
+        """
+        Groups records into contiguous ranges of --chunk_size commits and yields
+        (index snapshot, items, cached docs). The coordinator moves its own copy
+        of the last-touch index over each range before reading the next one.
+        """
+        records = iter(records)
+        while True:
+            chunk = [record for _, record in zip(range(self.args.chunk_size), records)]
+            if not chunk:
+                return
+
+            snapshot = None
+            if self.last_touch is not None:
+                snapshot = self.index_snapshot(chunk)
+                for _, details, file_stats in chunk:
+                    if len(details['parents']) < 2:
+                        self.update_last_touch(file_stats, details['author'], details['date'])
+
+            items = []
+            cached_docs = {}
+            for commit_hash, details, file_stats in chunk:
+                cached = False
+                if self.cache is not None:
+                    cached, doc = self.cache.get(self.args.project_name, self.args.repository_name, commit_hash)
+                    if cached:
+                        cached_docs[commit_hash] = doc
+                items.append((commit_hash, details, file_stats, cached))
+            yield snapshot, items, cached_docs
+
+    def analyze_parallel(self, records):
+        """
+        Analyses commits in a pool of --workers processes. Ranges are submitted in
+        order and their results are consumed in the same order, so documents reach
+        the cache and the bulk sink exactly as in a serial run.
+        """
+        workers = self.args.workers
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(self.args,)) as pool:
+            pending = deque()
+            for snapshot, items, cached_docs in self.iter_chunks(records):
+                pending.append((items, cached_docs, pool.submit(analyze_chunk_in_worker, snapshot, items)))
+                # Bound the number of ranges in flight to keep memory flat.
+                while len(pending) > 2 * workers:
+                    self.collect_chunk(*pending.popleft())
+            while pending:
+                self.collect_chunk(*pending.popleft())
+
+    def collect_chunk(self, items, cached_docs, future):
+        docs, profile, skipped = future.result()
+        if profile:
+            self.profiler.merge(profile)
+        for key, value in skipped.items():
+            self.skipped[key] += value
+        for (commit_hash, _, _, cached), doc in zip(items, docs):
+            if cached:
+                doc = cached_docs[commit_hash]
+            elif self.cache is not None:
+                self.cache.put(self.args.project_name, self.args.repository_name, commit_hash, doc)
+            self.handle_doc(commit_hash, doc)
+
+    def handle_doc(self, commit_hash, result):
+        """
+        Sends what analyze_commit returned for a commit: a document, None, or a
+        list of documents (one per project) in a --path_map run.
+        """
+        self.commit_count += 1
+        docs = result if isinstance(result, list) else [result] if result else []
+        for doc in docs:
+            self.document_count += 1
+            if self.ref_containment is not None:
+                # Added at send time, so cached documents never carry stale refs.
+                doc['refs'] = self.ref_containment.refs_for(doc['sha'])
+            if self.impact_sketches is not None:
+                self.add_to_impact_sketch(doc)
+            if self.ownership is not None:
+                self.ownership.add(doc)
+            if self.hotspots is not None:
+                key = (doc['project_name'], doc['repository_name'])
+                if key not in self.hotspots:
+                    self.hotspots[key] = ChurnHotspots(self.args.hotspot_window_days)
+                self.hotspots[key].add(doc)
+            self.send_to_elasticsearch(doc)
+            if self.path_map is None:
+                print(f"Processed commit {commit_hash[:6]} ({doc['category']})")
+            else:
+                print(f"Processed commit {commit_hash[:6]} for {doc['project_name']}/{doc['repository_name']} ({doc['category']})")
+
+    def run(self):
+        started = time.perf_counter()
+        with IndexManager(self.es, self.args.index_name).session(self.args):
+            self.sink = BulkSink.from_args(self.es, self.args)
+            try:
+                head = self.analyze()
+            finally:
+                self.sink.close()
+        self.finish(head)
+        if self.profiler.enabled:
+            write_profile_summary(
+                self.args.profile,
+                self.profiler.summary(time.perf_counter() - started, self.commit_count, self.sink)
+            )
+
+    def select_revisions(self):
+        """
+        Returns (head, rev_args) for this run: the commit(s) to record as the
+        high-water mark of an incremental run (None otherwise) and the git
+        revision arguments of the walk.
+        """
+        head = None
+        if self.args.all_refs or self.args.refs:
+            tips = self.list_refs()
+            if not tips:
+                raise ValueError(f"No refs match {' '.join(self.args.refs or ['--all_refs'])}")
+            tip_commits = sorted(set(tips.values()))
+            print(f"Walking {len(tips)} refs ({len(tip_commits)} distinct tips)")
+            rev_args = self.get_rev_args(tip_commits)
+            self.ref_containment = RefContainment.build(self.repo_path, tips, rev_args, self.profiler)
+            if self.args.incremental:
+                head = tip_commits
+        elif self.args.incremental:
+            head = self.run_git_command(['git', 'rev-parse', 'HEAD'])
+            rev_args = self.get_rev_args(head)
+        else:
+            rev_args = self.get_rev_args('HEAD')
+        return head, rev_args
+
+    def analyze(self):
+        """
+        Analyses the selected commits and queues their documents on self.sink.
+        Returns the HEAD commit (the list of ref tips with --all_refs/--refs) of an
+        incremental run and None otherwise, to be recorded by finish once the sink
+        has flushed.
+        """
+        head, rev_args = self.select_revisions()
+        try:
+            self.analyze_range(rev_args)
+            if self.ownership is not None:
+                self.send_ownership()
+            if self.hotspots is not None:
+                self.report_hotspots()
+            self.save_impact_sketches()
+        finally:
+            if self.object_reader is not None:
+                self.object_reader.close()
+                self.object_reader = None
+            if self.cache is not None:
+                print(f"Commit cache: {self.cache.hits} hits, {self.cache.misses} misses")
+                self.cache.close()
+            if self.ownership is not None:
+                self.ownership.close()
+            if self.sketched_commits is not None:
+                # Only reached when analysing failed; nothing of this run is counted.
+                self.sketched_commits.close()
+                self.sketched_commits = None
+        self.print_skipped()
+        return head
+
+    def report_hotspots(self):
+        """
+        Prints the --hotspots files churning most in the window that ends with the
+        newest analysed commit, per project/repository, and queues the report on
+        the sink when --hotspot_index is set.
+        """
+        for (project_name, repository_name), tracker in sorted(self.hotspots.items()):
+            start, end = tracker.window_bounds()
+            hotspots = tracker.top(self.args.hotspots)
+            print(f"Churn hotspots for {project_name}/{repository_name} "
+                  f"({datetime.fromtimestamp(start).date()} - {datetime.fromtimestamp(end).date()}):")
+            for rank, hotspot in enumerate(hotspots, 1):
+                print(f"  {rank}. {hotspot['file']}: {hotspot['commits']} commits, {hotspot['lines']} lines, "
+                      f"{hotspot['authors']} authors")
+            summarized = tracker.summarized_commits()
+            if summarized:
+                print(f"  ({summarized} mega-commits in the window count only their "
+                      f"--mega_commit_top_files most changed files)")
+            if self.args.hotspot_index:
+                doc = {
+                    'project_name': project_name,
+                    'repository_name': repository_name,
+                    'window_start': datetime.fromtimestamp(start).isoformat(),
+                    'window_end': datetime.fromtimestamp(end).isoformat(),
+                    'window_days': self.args.hotspot_window_days,
+                    'files_in_window': len(tracker.totals),
+                    'summarized_commits': summarized,
+                    'hotspots': hotspots,
+                    'date': datetime.now().isoformat()
+                }
+                doc_id = f"{project_name}/{repository_name}:{doc['window_end']}"
+                self.sink.send(doc_id, doc, source=self.high_water_mark_key(), index_name=self.args.hotspot_index)
+
+    def send_ownership(self):
+        """
+        Stores the ownership counters and queues the current ownership document of
+        every directory of this run's projects on the sink.
+        """
+        self.ownership.save()
+        now = time.time()
+        count = 0
+        keys = self.path_map.keys() if self.path_map else [(self.args.project_name, self.args.repository_name)]
+        for project_name, repository_name in keys:
+            for doc in self.ownership.documents(project_name, repository_name, now, self.args.ownership_top):
+                doc_id = f"{project_name}/{repository_name}:{doc['directory']}"
+                self.sink.send(doc_id, doc, source=self.high_water_mark_key(), index_name=self.args.ownership_index)
+                count += 1
+        print(f"Queued {count} ownership documents for {self.args.ownership_index}")
+
+    def print_skipped(self):
+        if self.excluded_paths is not None:
+            print(f"Skipped {self.skipped['files']} generated, vendored or excluded files "
+                  f"(+{self.skipped['insertions']}/-{self.skipped['deletions']} lines); "
+                  f"{self.skipped['commits']} commits changed only such files")
+
+    def save_impact_sketches(self):
+        """
+        Stores the impact sketches and the commits counted into them. Called at
+        the end of analyze, on the thread that opened SketchedCommits (a worker
+        thread of a --manifest run).
+        """
+        for key, sketch in (self.impact_sketches or {}).items():
+            update_state_file(self.impact_sketch_path(), key, sketch.state())
+        if self.sketched_commits is not None:
+            self.sketched_commits.save()
+            self.sketched_commits.close()
+            self.sketched_commits = None
+
+    def finish(self, head):
+        """
+        Advances the high-water mark after the sink has been closed, unless some
+        of this repository's documents failed to index.
+        """
+        if head:
+            if self.sink.failed_by_source.get(self.high_water_mark_key()):
+                print("Not advancing the high-water mark because some documents failed to index")
+            else:
+                self.save_high_water_mark(head)
+
+    def run_queue(self):
+        """
+        --queue: plans a backfill (--queue_init) or works on it (--queue_worker).
+        """
+        work_queue = WorkQueue(self.args.queue)
+        try:
+            if self.args.queue_init:
+                return self.plan_backfill(work_queue)
+            return self.work_backfill(work_queue)
+        finally:
+            work_queue.close()
+
+    def plan_backfill(self, work_queue):
+        """
+        Splits the selected commits, parents before children, into chunks of
+        --chunk_size and stores them in the queue. Re-running it resumes the
+        existing plan instead of adding a second one.
+        """
+        _, rev_args = self.select_revisions()
+        output = self.run_git_command(['git', 'rev-list', '--topo-order', '--reverse', '--no-merges'] + rev_args + ['HEAD'])
+        commits = (output or '').split()
+        size = self.args.chunk_size
+        chunks = [commits[start:start + size] for start in range(0, len(commits), size)]
+        key = self.high_water_mark_key()
+        if work_queue.add_chunks(self.args.project_name, self.args.repository_name, chunks):
+            print(f"Queued {len(commits)} commits of {key} in {len(chunks)} chunks")
+        else:
+            print(f"{key} is already queued, resuming the existing plan")
+            if self.args.queue_retry_failed:
+                print(f"Re-queued {work_queue.retry_failed(self.args.project_name, self.args.repository_name)} "
+                      f"failed chunks of {key}")
+        print(f"Queue status for {key}: {work_queue.status(self.args.project_name, self.args.repository_name)}")
+        return True
+
+    def work_backfill(self, work_queue):
+        """
+        Leases and analyses chunks until every chunk is done or failed. When the
+        remaining chunks are leased by other workers or waiting for a retry, waits
+        for them so the chunk of a worker that died is picked up again. Returns
+        False when chunks failed for good.
+        """
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+        project_name, repository_name = self.args.project_name, self.args.repository_name
+        # Workers on other hosts would overwrite each other's impact sketches.
+        self.impact_sketches = None
+        if not self.args.no_index_template:
+            IndexManager(self.es, self.args.index_name).install_template(shards=self.args.index_shards)
+        completed = 0
+        try:
+            while True:
+                lease = work_queue.lease(project_name, repository_name, worker, self.args.lease_seconds)
+                if lease is None:
+                    expiry = work_queue.next_expiry(project_name, repository_name)
+                    if expiry is None:
+                        break
+                    time.sleep(min(30.0, max(1.0, expiry - time.time())))
+                    continue
+                chunk, commits, attempts = lease
+                print(f"Worker {worker} leased chunk {chunk} ({len(commits)} commits, attempt {attempts})")
+                if self.analyze_leased_chunk(work_queue, worker, chunk, commits, attempts):
+                    completed += 1
+        finally:
+            if self.object_reader is not None:
+                self.object_reader.close()
+                self.object_reader = None
+            if self.cache is not None:
+                self.cache.close()
+        status = work_queue.status(project_name, repository_name)
+        print(f"Worker {worker} completed {completed} chunks; queue status: {status}")
+        self.print_skipped()
+        if status['failed']:
+            print(f"Error: {status['failed']} chunks failed after {self.args.queue_max_attempts} attempts; "
+                  f"reset them with --queue_init --queue_retry_failed once the cause is fixed")
+            return False
+        return True
+
+    def analyze_leased_chunk(self, work_queue, worker, chunk, commits, attempts):
+        """
+        Analyses one chunk with its own bulk sink, renewing the lease as it goes.
+        The chunk is only marked done once all of its documents were indexed;
+        otherwise it is retried after a backoff, up to --queue_max_attempts times.
+        """
+        project_name, repository_name = self.args.project_name, self.args.repository_name
+        lease_seconds = self.args.lease_seconds
+        # Each chunk starts with an empty index that is seeded from git on demand.
+        self.last_touch = {} if self.args.single_pass else None
+        self.sink = BulkSink.from_args(self.es, self.args)
+        renewed = time.monotonic()
+        lost = False
+        try:
+            for commit_hash in commits:
+                if time.monotonic() - renewed > lease_seconds / 3:
+                    if not work_queue.renew(project_name, repository_name, chunk, worker, lease_seconds):
+                        lost = True
+                        break
+                    renewed = time.monotonic()
+                details = file_stats = None
+                if self.last_touch is not None:
+                    details = self.get_commit_details(commit_hash)
+                    file_stats = self.get_file_stats(commit_hash)
+                self.handle_doc(commit_hash, self.analyze_commit(commit_hash, details, file_stats))
+        except BaseException:
+            work_queue.release(project_name, repository_name, chunk, worker)
+            raise
+        finally:
+            self.sink.close()
+
+        if lost:
+            print(f"Lease on chunk {chunk} expired and was taken over; leaving it to the other worker")
+            return False
+        if self.sink.failed:
+            if attempts >= self.args.queue_max_attempts:
+                print(f"Marking chunk {chunk} failed: {self.sink.failed} documents failed to index "
+                      f"on attempt {attempts}")
+                work_queue.fail(project_name, repository_name, chunk, worker)
+                return False
+            retry_after = min(QUEUE_RETRY_MAX_SECONDS, QUEUE_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+            print(f"Releasing chunk {chunk} because {self.sink.failed} documents failed to index; "
+                  f"retrying in {retry_after}s")
+            work_queue.release(project_name, repository_name, chunk, worker, retry_after)
+            return False
+        return work_queue.complete(project_name, repository_name, chunk, worker)
+
+    def iter_records(self, rev_args):
+        """
+        Yields (commit_hash, details, file_stats) for the commits to analyse.
+        details and file_stats are None when they still have to be read from git.
+        """
+        if self.args.single_pass:
+            print(f"Streaming commits for {' '.join(rev_args)}")
+            # Oldest-to-newest so the last-touch index is always up to date.
+            self.last_touch = {}
+            count = 0
+            for details, file_stats in self.iter_log_commits(rev_args + ['--reverse']):
+                count += 1
+                yield details['hash'], details, file_stats
+            print(f"Streamed {count} commits")
+        else:
+            commits = self.run_git_command(['git', 'log'] + rev_args + ['--pretty=format:%H']).split()
+
+            print(f"Found {len(commits)} commits for {' '.join(rev_args)}")
+
+            for commit_hash in commits:
+                yield commit_hash, None, None
+
+    def analyze_range(self, rev_args):
+        records = self.iter_records(rev_args)
+        if self.args.workers > 1:
+            self.analyze_parallel(records)
+            return
+
+        for commit_hash, details, file_stats in records:
+            self.handle_doc(commit_hash, self.analyze_commit(commit_hash, details, file_stats))
+
+def write_profile_summary(path, summary):
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=2)
+    print(f"Profile: {summary['commits']} commits, {summary['commits_per_second']} commits/sec, "
+          f"p95 {summary['commit_latency_ms']['p95']} ms; summary written to {path}")
+
+
+def load_manifest(manifest_file):
+    """
+    Loads repositories from a manifest file with one repository per line:
+        /repos/payments-api,Payments,payments-api
+    i.e. path, project name and repository name separated by commas.
+    Empty lines and lines starting with '#' are ignored.
+    """
+    entries = []
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        for line_num, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = [part.strip() for part in line.split(',')]
+            if len(parts) != 3 or not all(parts):
+                print(f"Warning: {manifest_file}:{line_num}: expected 'path,project_name,repository_name', got '{line}'")
+                continue
+            entries.append(tuple(parts))
+    return entries
+
+
+class RepositoryBatchRunner:
+    """
+    Analyses every repository of a manifest in one process. Repositories run
+    concurrently on a bounded thread pool and share one Elasticsearch client,
+    one bulk sink and one loaded user mapping.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.entries = load_manifest(args.manifest)
+        self.users = GitCommitAnalyzer.load_users(args.names_input_file)
+        self.teams = GitCommitAnalyzer.load_teams(args.teams_file)
+        self.es = GitCommitAnalyzer.init_elasticsearch(args)
+        self.sink = None
+
+    def analyze_repository(self, entry):
+        repo_path, project_name, repository_name = entry
+        repo_args = argparse.Namespace(**vars(self.args))
+        repo_args.repo_path = repo_path
+        repo_args.project_name = project_name
+        repo_args.repository_name = repository_name
+
+        started = time.monotonic()
+        analyzer = None
+        head = None
+        error = None
         try:
-            self.es.index(
-                index=self.args.index_name,
-                id=doc['sha'],
-                document=doc
+            analyzer = GitCommitAnalyzer(repo_args, users=self.users, es=self.es, teams=self.teams)
+            analyzer.sink = self.sink
+            head = analyzer.analyze()
+        except Exception as e:
+            error = str(e)
+            print(f"Failed to analyse {project_name}/{repository_name} at {repo_path}: {error}")
+        return {
+            'entry': entry,
+            'analyzer': analyzer,
+            'head': head,
+            'error': error,
+            'seconds': time.monotonic() - started
+        }
+
+    def run(self):
+        print(f"Analysing {len(self.entries)} repositories from {self.args.manifest}")
+        started = time.perf_counter()
+        with IndexManager(self.es, self.args.index_name).session(self.args):
+            self.sink = BulkSink.from_args(self.es, self.args)
+            try:
+                with ThreadPoolExecutor(max_workers=self.args.repo_concurrency) as pool:
+                    results = list(pool.map(self.analyze_repository, self.entries))
+            finally:
+                self.sink.close()
+
+        if self.args.profile:
+            profiler = Profiler(enabled=True)
+            for result in results:
+                if result['analyzer']:
+                    profiler.merge(result['analyzer'].profiler.state())
+            commits = sum(result['analyzer'].commit_count for result in results if result['analyzer'])
+            write_profile_summary(
+                self.args.profile,
+                profiler.summary(time.perf_counter() - started, commits, self.sink)
             )
-            time.sleep(0.1)
-        except TransportError as e:
-            print(f"Failed to index document {doc['sha']}: {str(e)}")
+
+        print("Repository summary:")
+        for result in results:
+            _, project_name, repository_name = result['entry']
+            key = f"{project_name}/{repository_name}"
+            analyzer = result['analyzer']
+            if analyzer and not result['error']:
+                analyzer.finish(result['head'])
+            commits = analyzer.commit_count if analyzer else 0
+            documents = analyzer.document_count if analyzer else 0
+            failed = self.sink.failed_by_source.get(key, 0)
+            status = f"error: {result['error']}" if result['error'] else f"{failed} index failures"
+            print(f"  - {key}: {commits} commits, {documents} documents, {result['seconds']:.1f}s, {status}")
+        return all(not result['error'] for result in results) and self.sink.failed == 0
+
+
+class CommitRescorer:
+    """
+    --rescore: recomputes category, cefficiency and commit_impact of the documents
+    already in --index_name from the inputs stored with them (files, insertions,
+    deletions, category_counts), without running git. Documents are read in
+    batches through a point in time with search_after, and only the scores that
+    changed are written back as bulk partial updates. With --state_dir each
+    repository is scored with its own --calibrate_impact midpoint/steepness.
+    """
+
+    SCORE_FIELDS = ('category', 'cefficiency', 'commit_impact', 'raw_impact')
+    SOURCE_FIELDS = [
+        'project_name', 'repository_name', 'category', 'category_counts', 'cefficiency', 'commit_impact',
+        'raw_impact', 'insertions', 'deletions', 'total_files_changed', 'files', 'files_summarized',
+        'file_extensions'
+    ]
+
+    def __init__(self, args, es=None):
+        self.args = args
+        self.es = es if es is not None else GitCommitAnalyzer.init_elasticsearch(args)
+        # Only the scoring settings are needed, so no user mapping, cache or git access.
+        self.analyzer = GitCommitAnalyzer(args, worker=True, users={})
+        self.sink = None
+        self.scanned = 0
+        self.changed = 0
+
+    def exact_fields(self, field):
+        """
+        Returns {exact-match field: [indices]} for field: the field itself on
+        indices where it is a keyword (index template), its .keyword sub-field on
+        indices that still have the dynamic text mapping. A match on the text
+        field would also select "Payments Legacy" for "Payments".
+        """
+        response = self.es.indices.get_field_mapping(index=self.args.index_name, fields=[field, f'{field}.keyword'])
+        indices = defaultdict(list)
+        for index, entry in sorted(dict(response).items()):
+            mappings = entry.get('mappings', {})
+            leaf = mappings.get(field, {}).get('mapping', {}).get(field, {})
+            if leaf.get('type') == 'keyword':
+                indices[field].append(index)
+            elif f'{field}.keyword' in mappings:
+                indices[f'{field}.keyword'].append(index)
+        return indices
+
+    def term_filter(self, field, value):
+        indices = self.exact_fields(field)
+        if len(indices) == 1:
+            return {'term': {next(iter(indices)): value}}
+        # Indices behind an alias or pattern can differ; match each with its own field.
+        return {'bool': {'should': [
+            {'bool': {'filter': [{'terms': {'_index': names}}, {'term': {exact_field: value}}]}}
+            for exact_field, names in sorted(indices.items())
+        ], 'minimum_should_match': 1}}
+
+    def query(self):
+        filters = [
+            self.term_filter(field, value)
+            for field, value in (('project_name', self.args.project_name),
+                                 ('repository_name', self.args.repository_name))
+            if value
+        ]
+        return {'bool': {'filter': filters}} if filters else {'match_all': {}}
+
+    def iter_batches(self):
+        """
+        Yields lists of search hits until the point in time is exhausted.
+        """
+        keep_alive = self.args.rescore_keep_alive
+        query = self.query()
+        pit_id = self.es.open_point_in_time(index=self.args.index_name, keep_alive=keep_alive)['id']
+        search_after = None
+        try:
+            while True:
+                body = {
+                    'size': self.args.rescore_batch_size,
+                    'query': query,
+                    '_source': self.SOURCE_FIELDS,
+                    'pit': {'id': pit_id, 'keep_alive': keep_alive},
+                    'sort': [{'_shard_doc': 'asc'}]
+                }
+                if search_after is not None:
+                    body['search_after'] = search_after
+                response = self.es.search(body=body)
+                pit_id = response.get('pit_id', pit_id)
+                hits = response['hits']['hits']
+                if not hits:
+                    return
+                yield hits
+                search_after = hits[-1]['sort']
+        finally:
+            self.es.close_point_in_time(body={'id': pit_id})
+
+    def rescore_batch(self, hits):
+        docs = [hit['_source'] for hit in hits]
+        for hit, doc, scores in zip(hits, docs, self.analyzer.score_documents(docs)):
+            changed = {field: scores[field] for field in self.SCORE_FIELDS if doc.get(field) != scores[field]}
+            if changed:
+                self.sink.update(hit['_id'], changed, index_name=hit['_index'])
+                self.changed += 1
+        self.scanned += len(hits)
 
     def run(self):
-        commits = self.run_git_command([
-            'git', 'log',
-            '--since', self.args.since,
-            '--until', self.args.until,
-            '--pretty=format:%H'
-        ]).split()
-        
-        print(f"Found {len(commits)} commits, between {self.args.until} - {self.args.since}")
-        
-        for commit_hash in commits:
-            doc = self.process_commit(commit_hash)
-            if doc:
-                self.send_to_elasticsearch(doc)
-                print(f"Processed commit {commit_hash[:6]} ({doc['category']})")
+        print(f"Rescoring documents in {self.args.index_name}")
+        self.sink = BulkSink.from_args(self.es, self.args)
+        try:
+            for hits in self.iter_batches():
+                self.rescore_batch(hits)
+        finally:
+            self.sink.close()
+        print(f"Rescored {self.scanned} documents, {self.changed} changed")
+        return self.sink.failed == 0
 
-if __name__ == "__main__":
+
+def calibrate_impact(args):
+    """
+    --calibrate_impact: derives the commit_impact midpoint and steepness of every
+    repository with an impact sketch in --state_dir (or only --project_name/
+    --repository_name) and stores them for later runs and --rescore.
+    """
+    sketches = load_state_file(os.path.join(args.state_dir, 'impact_sketches.json'))
+    only = f"{args.project_name}/{args.repository_name}" if args.project_name and args.repository_name else None
+    calibrated = 0
+    for key, state in sorted(sketches.items()):
+        if only and key != only:
+            continue
+        calibration = ImpactSketch(state).calibration()
+        if calibration is None:
+            print(f"  - {key}: not enough commits to calibrate")
+            continue
+        update_state_file(os.path.join(args.state_dir, 'impact_calibration.json'), key, calibration)
+        calibrated += 1
+        print(f"  - {key}: midpoint {calibration['midpoint']}, steepness {calibration['steepness']} "
+              f"({calibration['commits']} commits)")
+    print(f"Calibrated commit impact for {calibrated} repositories")
+    return calibrated > 0
+
+
+def build_arg_parser():
     parser = argparse.ArgumentParser(description='Analyze Git commits and send to Elasticsearch')
     parser.add_argument('--since', default='3 week ago', help='Time range start')
     parser.add_argument('--until', default='now', help='Time range end')
-    parser.add_argument('--project_name', required=True, help='Project name')
-    parser.add_argument('--repository_name', required=True, help='Repository name')
+    parser.add_argument('--project_name', help='Project name (required without --manifest)')
+    parser.add_argument('--repository_name', help='Repository name (required without --manifest)')
+    parser.add_argument('--repo_path', default='.', help='Path of the git repository to analyse')
+    parser.add_argument('--manifest',
+                        help='File listing repositories as "path,project_name,repository_name" lines '
+                             'to analyse in one run')
+    parser.add_argument('--repo_concurrency', type=int, default=4,
+                        help='Number of manifest repositories analysed at the same time')
     parser.add_argument('--elasticsearch_host', default='http://localhost:9200', help='Elasticsearch host URL')
     parser.add_argument('--index_name', default='git-stats-combined', help='Elasticsearch index name')
     parser.add_argument('--elasticsearch_username', help='Elasticsearch username')
     parser.add_argument('--elasticsearch_password', help='Elasticsearch password')
     parser.add_argument('--names_input_file', default='users.txt', help='User mapping file')
+    parser.add_argument('--teams_file',
+                        help='Team mapping file in the dora-metrics.py teams.txt format; adds a team field '
+                             'to every document')
+    parser.add_argument('--no_index_template', action='store_true',
+                        help='Do not install the index template with the tuned mappings for --index_name')
+    parser.add_argument('--index_shards', type=int,
+                        help='Number of primary shards in the index template for --index_name '
+                             '(default: the cluster default)')
+    parser.add_argument('--backfill', action='store_true',
+                        help='For large loads: disable refreshes and replicas of --index_name during the run, '
+                             'then restore them and force-merge the index')
+    parser.add_argument('--single_pass', action='store_true',
+                        help='Read all commits and numstats from one streaming git log process')
+    parser.add_argument('--state_dir',
+                        help='Directory for persistent analyzer state; enables the commit analysis cache')
+    parser.add_argument('--bulk_size', type=int, default=500,
+                        help='Number of documents per Elasticsearch bulk request')
+    parser.add_argument('--flush_interval', type=float, default=5.0,
+                        help='Maximum seconds a document waits before its bulk request is sent')
+    parser.add_argument('--bulk_queue_size', type=int, default=2000,
+                        help='Documents buffered ahead of the bulk sink before analysis blocks')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes analysing commits in parallel')
+    parser.add_argument('--chunk_size', type=int, default=500,
+                        help='Number of consecutive commits handed to a worker at a time')
+    parser.add_argument('--all_refs', action='store_true',
+                        help='Analyse every commit reachable from any branch, remote-tracking branch or tag '
+                             'once, recording the refs that contain it')
+    parser.add_argument('--refs', action='append', metavar='PATTERN',
+                        help='Like --all_refs, for the refs matching a git for-each-ref pattern '
+                             '(e.g. refs/heads/release/*); may be repeated')
+    parser.add_argument('--path_map',
+                        help='Monorepo file with "pattern,project_name,repository_name" lines; each commit is split '
+                             'into one document per project owning its paths (unmatched paths stay in '
+                             '--project_name/--repository_name)')
+    parser.add_argument('--queue', metavar='QUEUE_DB',
+                        help='SQLite work queue for a backfill shared by several worker processes or hosts; '
+                             'use with --queue_init or --queue_worker')
+    parser.add_argument('--queue_init', action='store_true',
+                        help='Split the --since/--until range into --chunk_size chunks and store them in --queue')
+    parser.add_argument('--queue_worker', action='store_true',
+                        help='Lease chunks from --queue and analyse them until the backfill is done')
+    parser.add_argument('--lease_seconds', type=int, default=900,
+                        help='How long a leased chunk stays reserved for a worker without renewal')
+    parser.add_argument('--queue_max_attempts', type=int, default=5,
+                        help='Mark a chunk failed after this many leases that could not index all of its '
+                             'documents (default: 5)')
+    parser.add_argument('--queue_retry_failed', action='store_true',
+                        help='With --queue_init, put failed chunks back into the queue')
+    parser.add_argument('--skip_generated', action='store_true',
+                        help='Leave files the repository\'s .gitattributes mark as linguist-generated, '
+                             'linguist-vendored or -diff out of categorization and scoring')
+    parser.add_argument('--exclude', action='append', metavar='PATTERN',
+                        help='Leave files matching this .gitignore style pattern (e.g. package-lock.json, '
+                             'vendor/) out of categorization and scoring; may be repeated')
+    parser.add_argument('--ownership_index',
+                        help='Keep time-decayed per-directory contributor counters in --state_dir and write one '
+                             'ownership document (top contributors, bus factor) per directory to this index')
+    parser.add_argument('--ownership_half_life_days', type=float, default=180.0,
+                        help='Days after which a change counts half as much towards ownership')
+    parser.add_argument('--ownership_depth', type=int, default=3,
+                        help='Deepest directory level that gets an ownership document')
+    parser.add_argument('--ownership_top', type=int, default=10,
+                        help='Number of contributors listed in each ownership document')
+    parser.add_argument('--hotspots', type=int, default=0, metavar='K',
+                        help='Report the K files with the most commits in the last --hotspot_window_days days of '
+                             'the analysed history, per repository (0 disables)')
+    parser.add_argument('--hotspot_window_days', type=int, default=21,
+                        help='Length of the churn hotspot window in days')
+    parser.add_argument('--hotspot_index',
+                        help='Also write the --hotspots report of each repository as a document to this index')
+    parser.add_argument('--mega_commit_files', type=int, default=2000,
+                        help='Commits changing more files than this are categorized per directory and '
+                             'stored with a summarised file list (0 disables)')
+    parser.add_argument('--mega_commit_top_files', type=int, default=100,
+                        help='Number of most changed files kept in the document of a mega-commit')
+    parser.add_argument('--profile', metavar='SUMMARY_JSON',
+                        help='Count and time git commands and analysis stages and write a JSON summary')
+    parser.add_argument('--profile_dump', metavar='PROFILE_FILE',
+                        help='Also run under cProfile and dump the stats to this file')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only analyse commits after the high-water mark stored in --state_dir; '
+                             '--since/--until are used when no mark exists yet')
+    parser.add_argument('--calibrate_impact', action='store_true',
+                        help='Derive the commit_impact midpoint/steepness of each repository from the raw impact '
+                             'percentiles collected in --state_dir; later runs and --rescore use them')
+    parser.add_argument('--rescore', action='store_true',
+                        help='Recompute category, cefficiency and commit_impact of the documents in --index_name '
+                             'without reading git; --project_name/--repository_name narrow it down')
+    parser.add_argument('--rescore_batch_size', type=int, default=1000,
+                        help='Number of documents read per search request in --rescore mode')
+    parser.add_argument('--rescore_keep_alive', default='5m',
+                        help='How long the point in time used by --rescore is kept between requests')
+
+    return parser
+
+
+def parse_arguments(argv=None):
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+    if args.incremental and not args.state_dir:
+        parser.error('--incremental requires --state_dir')
+    if args.calibrate_impact and not args.state_dir:
+        parser.error('--calibrate_impact requires --state_dir')
+    if args.ownership_index and not args.state_dir:
+        parser.error('--ownership_index requires --state_dir')
+    if args.queue and args.queue_init == args.queue_worker:
+        parser.error('--queue requires exactly one of --queue_init and --queue_worker')
+    if (args.queue_init or args.queue_worker) and not args.queue:
+        parser.error('--queue_init and --queue_worker require --queue')
+    if args.queue_retry_failed and not args.queue_init:
+        parser.error('--queue_retry_failed requires --queue_init')
+    if args.index_shards is not None and args.index_shards < 1:
+        parser.error('--index_shards must be at least 1')
+    if args.queue_max_attempts < 1:
+        parser.error('--queue_max_attempts must be at least 1')
+    if args.queue and (args.incremental or args.all_refs or args.refs or args.manifest or args.ownership_index
+                       or args.hotspots):
+        parser.error('--queue cannot be combined with --incremental, --all_refs, --refs, --manifest, '
+                     '--ownership_index or --hotspots')
+    if args.hotspot_index and not args.hotspots:
+        parser.error('--hotspot_index requires --hotspots')
+    if args.backfill and (args.queue or args.rescore or args.calibrate_impact):
+        # A queue worker cannot tell when the other workers are done.
+        parser.error('--backfill cannot be combined with --queue, --rescore or --calibrate_impact')
+    if not (args.manifest or args.rescore or args.calibrate_impact) and not (args.project_name and args.repository_name):
+        parser.error('--project_name and --repository_name are required without --manifest')
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    profile = cProfile.Profile() if args.profile_dump else None
+    if profile:
+        profile.enable()
+    try:
+        if args.calibrate_impact:
+            success = calibrate_impact(args)
+        elif args.rescore:
+            success = CommitRescorer(args).run()
+        elif args.queue:
+            success = GitCommitAnalyzer(args, worker=args.queue_init).run_queue()
+        elif args.manifest:
+            runner = RepositoryBatchRunner(args)
+            success = runner.run()
+        else:
+            analyzer = GitCommitAnalyzer(args)
+            analyzer.run()
+            success = True
+    finally:
+        if profile:
+            profile.disable()
+            profile.dump_stats(args.profile_dump)
+            print(f"cProfile stats written to {args.profile_dump}")
 
-    args = parser.parse_args()
-    
-    analyzer = GitCommitAnalyzer(args)
-    analyzer.run()
+    if not success:
+        sys.exit(1)
 
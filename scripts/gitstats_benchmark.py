@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness for gitstats.py.
+
+Generates a reproducible synthetic git repository with `git fast-import` and
+runs GitCommitAnalyzer over it end to end, with a null or in-memory stand-in
+for the Elasticsearch bulk sink. Reports commits/sec, git subprocess counts
+and peak RSS so changes to categorize_file or process_commit can be compared
+at different repository sizes.
+
+Usage:
+python gitstats_benchmark.py --commits 10000 --files 2000 --authors 25 \
+                             --rename-rate 0.02 --output bench.json \
+                             -- --single_pass --workers 4
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from gitstats import GitCommitAnalyzer, build_arg_parser, dumps_document
+
+BASE_TIMESTAMP = 1600000000
+
+
+class NullSink:
+    """
+    Stand-in for gitstats.BulkSink. Documents are serialised as BulkSink does;
+    the null sink then only counts them, the memory sink also keeps them, so
+    the memory cost of holding results shows up in peak RSS.
+    """
+
+    def __init__(self, keep=False):
+        self.keep = keep
+        self.docs = []
+        self.indexed = 0
+        self.failed = 0
+        self.failed_by_source = {}
+        self.flushes = 0
+        self.flush_seconds = 0.0
+
+    def send(self, doc_id, doc, source=None, index_name=None):
+        body = dumps_document(doc)
+        self.indexed += 1
+        if self.keep:
+            self.docs.append(body)
+
+    def close(self):
+        pass
+
+
+class SyntheticRepositoryGenerator:
+    """
+    Builds a linear history through a `git fast-import` stream. Every choice is
+    drawn from a seeded random generator, so the same options always produce
+    the same repository (and the same commit SHAs).
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.files = {}  # path -> list of lines
+        self.authors = [(f"Developer {i:03d}", f"dev{i:03d}@example.com") for i in range(args.authors)]
+        self.directories = [f"src/module{i:02d}" for i in range(max(1, args.files // 50))]
+        self.extensions = ['py', 'js', 'java', 'cs', 'md', 'xml', 'json', 'sql', 'txt']
+        self.file_counter = 0
+        self.line_counter = 0
+
+    def file_size(self):
+        """
+        Number of lines for a new file, log-normally distributed around --mean-lines.
+        """
+        sigma = self.args.lines_sigma
+        mu = math.log(max(1, self.args.mean_lines)) - sigma * sigma / 2
+        return max(1, min(self.args.max_lines, int(self.random.lognormvariate(mu, sigma))))
+
+    def new_line(self):
+        self.line_counter += 1
+        return f"line {self.line_counter} {self.random.getrandbits(32):08x}"
+
+    def new_path(self):
+        self.file_counter += 1
+        directory = self.random.choice(self.directories)
+        return f"{directory}/file{self.file_counter:06d}.{self.random.choice(self.extensions)}"
+
+    def edit(self, lines):
+        """
+        Applies a small random mix of replaced, added and removed lines.
+        """
+        lines = list(lines)
+        for _ in range(self.random.randint(1, 3)):
+            action = self.random.random()
+            position = self.random.randint(0, len(lines))
+            count = self.random.randint(1, max(1, self.args.mean_lines // 10))
+            if action < 0.5 or not lines:
+                lines[position:position] = [self.new_line() for _ in range(count)]
+            elif action < 0.8:
+                lines[position:position + count] = [self.new_line() for _ in range(count)]
+            else:
+                del lines[position:position + count]
+        return lines
+
+    def commit_operations(self):
+        """
+        Yields fast-import file commands ('M', 'R', 'D') for one commit.
+        """
+        touched = set()
+        for _ in range(self.random.randint(1, self.args.files_per_commit)):
+            # Renames and deletes take the bottom of the range, so their rates hold
+            # whether or not the repository has reached --files yet.
+            roll = self.random.random()
+            rename_below = self.args.rename_rate
+            delete_below = rename_below + self.args.delete_rate
+            existing = [path for path in self.files if path not in touched] if self.files else []
+            if existing and roll < rename_below:
+                old_path = self.random.choice(existing)
+                new_path = self.new_path()
+                self.files[new_path] = self.files.pop(old_path)
+                touched.add(new_path)
+                yield 'R', (old_path, new_path)
+            elif existing and roll < delete_below and len(self.files) > 1:
+                path = self.random.choice(existing)
+                del self.files[path]
+                yield 'D', path
+            elif not existing or (len(self.files) < self.args.files and roll < delete_below + 0.3):
+                path = self.new_path()
+                self.files[path] = [self.new_line() for _ in range(self.file_size())]
+                touched.add(path)
+                yield 'M', path
+            else:
+                path = self.random.choice(existing)
+                self.files[path] = self.edit(self.files[path])
+                touched.add(path)
+                yield 'M', path
+
+    def stream(self):
+        """
+        Yields the fast-import stream as byte chunks, one commit at a time.
+        """
+        timestamp = BASE_TIMESTAMP
+        for number in range(1, self.args.commits + 1):
+            timestamp += self.random.randint(600, 2 * 24 * 3600)
+            name, email = self.random.choice(self.authors)
+            message = f"Synthetic commit {number}".encode('utf-8')
+            chunk = [
+                b"commit refs/heads/main\n",
+                f"mark :{number}\n".encode('utf-8'),
+                f"author {name} <{email}> {timestamp} +0000\n".encode('utf-8'),
+                f"committer {name} <{email}> {timestamp} +0000\n".encode('utf-8'),
+                f"data {len(message)}\n".encode('utf-8') + message + b"\n",
+            ]
+            if number > 1:
+                chunk.append(f"from :{number - 1}\n".encode('utf-8'))
+            for op, target in self.commit_operations():
+                if op == 'R':
+                    chunk.append(f'R "{target[0]}" "{target[1]}"\n'.encode('utf-8'))
+                    # Renamed files are usually touched as well.
+                    target = target[1]
+                    self.files[target] = self.edit(self.files[target])
+                    op = 'M'
+                if op == 'D':
+                    chunk.append(f'D "{target}"\n'.encode('utf-8'))
+                else:
+                    content = ('\n'.join(self.files[target]) + '\n').encode('utf-8')
+                    chunk.append(f'M 100644 inline "{target}"\n'.encode('utf-8'))
+                    chunk.append(f"data {len(content)}\n".encode('utf-8') + content + b"\n")
+            yield b''.join(chunk)
+
+    def generate(self, path):
+        os.makedirs(path)
+        subprocess.run(['git', 'init', '-q', '-b', 'main', path], check=True)
+        proc = subprocess.Popen(['git', 'fast-import', '--quiet'], stdin=subprocess.PIPE, cwd=path)
+        for chunk in self.stream():
+            proc.stdin.write(chunk)
+        proc.stdin.close()
+        if proc.wait() != 0:
+            raise RuntimeError(f"git fast-import failed with exit code {proc.returncode}")
+        subprocess.run(['git', 'reset', '-q', '--hard', 'main'], check=True, cwd=path)
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS.
+    rss = resource.getrusage(who).ru_maxrss
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(rss / divisor, 1)
+
+
+def run_benchmark(repo_path, analyzer_argv, sink):
+    args = build_arg_parser().parse_args([
+        '--project_name', 'benchmark',
+        '--repository_name', os.path.basename(repo_path),
+        '--repo_path', repo_path,
+        '--since', '1970-01-02',
+        '--names_input_file', os.devnull,
+        '--profile', os.devnull
+    ] + analyzer_argv)
+
+    analyzer = GitCommitAnalyzer(args)
+    analyzer.sink = sink
+    started = time.perf_counter()
+    analyzer.analyze()
+    elapsed = time.perf_counter() - started
+
+    profile = analyzer.profiler.summary(elapsed, analyzer.commit_count)
+    return {
+        'analyzer_args': analyzer_argv,
+        'commits': analyzer.commit_count,
+        'documents': sink.indexed,
+        'wall_seconds': round(elapsed, 3),
+        'commits_per_second': profile['commits_per_second'],
+        'git_processes': sum(entry['processes'] for entry in profile['git'].values()),
+        'git_requests': sum(entry['requests'] for entry in profile['git'].values()),
+        'peak_rss_mb': peak_rss_mb(resource.RUSAGE_SELF),
+        'peak_child_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+        'profile': profile
+    }
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark gitstats.py on a generated repository. "
+                    "Arguments after '--' are passed to the analyzer (e.g. -- --single_pass --workers 4)."
+    )
+    parser.add_argument("--commits", type=int, default=2000, help="Number of commits to generate (default: 2000)")
+    parser.add_argument("--files", type=int, default=500, help="Target number of files in the repository (default: 500)")
+    parser.add_argument("--authors", type=int, default=10, help="Number of distinct authors (default: 10)")
+    parser.add_argument("--files-per-commit", type=int, default=4, help="Maximum files touched per commit (default: 4)")
+    parser.add_argument("--mean-lines", type=int, default=120, help="Mean lines of a new file (default: 120)")
+    parser.add_argument("--lines-sigma", type=float, default=1.0, help="Log-normal sigma of file sizes (default: 1.0)")
+    parser.add_argument("--max-lines", type=int, default=20000, help="Upper bound for a new file's lines (default: 20000)")
+    parser.add_argument("--rename-rate", type=float, default=0.02, help="Probability that a file change is a rename (default: 0.02)")
+    parser.add_argument("--delete-rate", type=float, default=0.01, help="Probability that a file change is a delete (default: 0.01)")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed (default: 42)")
+    parser.add_argument("--repo-dir", help="Where to create the repository; reused when it already exists")
+    parser.add_argument("--sink", choices=['null', 'memory'], default='null', help="Elasticsearch stand-in (default: null)")
+    parser.add_argument("--output", help="Write the result as JSON to this file")
+    parser.add_argument("analyzer_args", nargs=argparse.REMAINDER, help="Arguments for gitstats.py")
+    args = parser.parse_args()
+    if args.analyzer_args and args.analyzer_args[0] == '--':
+        args.analyzer_args = args.analyzer_args[1:]
+    return args
+
+
+def main():
+    args = parse_arguments()
+
+    temp_dir = None
+    repo_path = args.repo_dir
+    if not repo_path:
+        temp_dir = tempfile.mkdtemp(prefix='gitstats-bench-')
+        repo_path = os.path.join(temp_dir, 'repo')
+
+    try:
+        if os.path.exists(repo_path):
+            print(f"Reusing repository at {repo_path}")
+        else:
+            started = time.perf_counter()
+            SyntheticRepositoryGenerator(args).generate(repo_path)
+            print(f"Generated {args.commits} commits in {repo_path} ({time.perf_counter() - started:.1f}s)")
+
+        result = run_benchmark(os.path.abspath(repo_path), args.analyzer_args, NullSink(keep=args.sink == 'memory'))
+        result['repository'] = {
+            'commits': args.commits,
+            'files': args.files,
+            'authors': args.authors,
+            'files_per_commit': args.files_per_commit,
+            'mean_lines': args.mean_lines,
+            'lines_sigma': args.lines_sigma,
+            'rename_rate': args.rename_rate,
+            'delete_rate': args.delete_rate,
+            'seed': args.seed
+        }
+
+        print(f"{result['commits']} commits in {result['wall_seconds']}s: "
+              f"{result['commits_per_second']} commits/sec, "
+              f"{result['git_processes']} git processes ({result['git_requests']} requests), "
+              f"peak RSS {result['peak_rss_mb']} MB")
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(result, f, indent=2)
+            print(f"Result written to {args.output}")
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()